@@ -0,0 +1,147 @@
+import hashlib
+import os
+import threading
+import time
+from flibusta_logger import logger
+from sqlite_store import SqliteStore, store_path
+
+# файлы моложе этого числа секунд не считаются брошенными: в режиме нескольких процессов
+# другой процесс мог только что перенести файл в кеш и еще не записать его в индекс
+ORPHAN_AGE = 600
+
+
+class BookCache(SqliteStore):
+    """Кеш сконвертированных книг на диске. Ключ - id книги на флибусте, формат и версия конвертера,
+    так что после изменения конвертера старые файлы просто перестают находиться и вытесняются.
+    Общий размер ограничен, при переполнении удаляются давно не скачивавшиеся книги.
+    Файл попадает в кеш одним переименованием, при выдаче сверяются размер и sha256.
+    Методы блокирующие, из бота их надо вызывать через asyncio.to_thread.
+    Индекс без path живет в памяти процесса: файлы прошлых запусков тогда не находятся и со временем удаляются.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS books (
+            key TEXT PRIMARY KEY, book_id INTEGER, format TEXT, version TEXT,
+            file TEXT NOT NULL, size INTEGER NOT NULL, sha256 TEXT NOT NULL, last_used REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS books_last_used ON books (last_used);'''
+    threaded = True
+
+    def __init__(self, directory='./files/books', max_bytes=2 * 1024 ** 3, path='./files/books/index.sqlite') -> None:
+        """
+        Args:
+            directory (str): папка кеша
+            max_bytes (int): максимальный общий размер файлов
+            path (str, optional): файл индекса кеша, None - индекс в памяти процесса
+        """
+        super().__init__(path)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(book_id, book_format, version):
+        return hashlib.sha256(f'{book_id}:{book_format}:{version}'.encode()).hexdigest()[:32]
+
+    @staticmethod
+    def file_digest(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def opened(self, db):
+        """Убираем давние файлы, которых нет в индексе (например, если бот упал между переносом файла и записью в индекс)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        known = {row[0] for row in db.execute('SELECT file FROM books')}
+        index_name = os.path.basename(self.path) if self.path else None
+        orphan_before = time.time() - ORPHAN_AGE
+        for name in os.listdir(self.directory):
+            if name in known or index_name and name.startswith(index_name):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < orphan_before:
+                    os.remove(path)
+            except OSError:
+                # файл уже удалил другой процесс
+                pass
+
+    def get(self, book_id, book_format, version):
+        """Путь до готовой книги из кеша
+
+        Returns:
+            str: путь до файла или None, если книги нет или файл поврежден
+        """
+        key = self.key(book_id, book_format, version)
+        with self.lock:
+            db = self.connect()
+            row = db.execute('SELECT file, size, sha256 FROM books WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            path = os.path.join(self.directory, row[0])
+            try:
+                valid = os.path.getsize(path) == row[1] and self.file_digest(path) == row[2]
+            except OSError:
+                valid = False
+            if not valid:
+                logger.warning(f'Файл книги {book_id}.{book_format} в кеше поврежден, удаляем')
+                self.forget(key, path)
+                return None
+            with db:
+                db.execute('UPDATE books SET last_used = ? WHERE key = ?', (time.time(), key))
+        return path
+
+    def put(self, book_id, book_format, version, source):
+        """Переносим сконвертированный файл в кеш и вытесняем старые книги, если кеш переполнен
+
+        Args:
+            book_id (int): id книги на флибусте
+            book_format (str): 'epub' или 'pdf'
+            version (str): версия конвертера
+            source (str): путь до готового файла, он будет перенесен в кеш
+
+        Returns:
+            str: путь до файла в кеше
+        """
+        key = self.key(book_id, book_format, version)
+        name = f'{key}.{book_format}'
+        path = os.path.join(self.directory, name)
+        size = os.path.getsize(source)
+        digest = self.file_digest(source)
+        with self.lock:
+            db = self.connect()
+            os.replace(source, path)
+            with db:
+                db.execute('INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           (key, book_id, book_format, str(version), name, size, digest, time.time()))
+            self.evict(keep=key)
+        return path
+
+    def evict(self, keep=None):
+        """Удаляем давно не использованные книги, пока кеш не влезет в max_bytes.
+        Только что добавленную книгу (keep) не трогаем, даже если она одна больше лимита
+        """
+        db = self.db
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM books').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, name, size in db.execute('SELECT key, file, size FROM books ORDER BY last_used').fetchall():
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.forget(key, os.path.join(self.directory, name))
+            total -= size
+            logger.debug(f'Книга {name} вытеснена из кеша')
+
+    def forget(self, key, path):
+        with self.db:
+            self.db.execute('DELETE FROM books WHERE key = ?', (key,))
+        if os.path.exists(path):
+            os.remove(path)
+
+
+book_cache = BookCache(max_bytes=int(os.getenv('FLIBUSTA_BOOK_CACHE_MB', '2048')) * 1024 ** 2,
+                       path=store_path('FLIBUSTA_BOOK_CACHE_DB', './files/books/index.sqlite'))
@@ -0,0 +1,102 @@
+import os
+import re
+import tempfile
+from lxml import etree
+from http_client import http_client
+
+
+CHUNK_SIZE = 64 * 1024
+AUTHOR_HREF_RE = re.compile(r'/a/\d+')
+BOOK_HREF_RE = re.compile(r'/b/\d+$')
+
+
+async def download_read_page(book_read_link, directory='./files'):
+    """Скачиваем страницу книги /read потоково, кусками прямо во временный файл,
+    чтобы страница целиком не держалась в памяти бота и не передавалась в процесс конвертации
+
+    Returns:
+        str, str: путь до файла и кодировка из заголовков ответа (None, если сервер ее не указал)
+    """
+    file = tempfile.NamedTemporaryFile(dir=directory, prefix='read_', suffix='.html', delete=False)
+    try:
+        with file:
+            async with http_client.stream(book_read_link) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    file.write(chunk)
+                encoding = response.charset
+    except BaseException:
+        os.remove(file.name)
+        raise
+    return file.name, encoding
+
+
+class BookPage:
+    """Потоковый разбор сохраненной страницы /read.
+    Итерация отдает элементы с классом book по одному, по мере чтения файла. Вложенные элементы
+    отдаются в составе внешнего. Уже отданные и прочитанные элементы сразу удаляются из дерева,
+    так что в памяти держится только текущий фрагмент, независимо от размера книги.
+    Автор и название книги берутся из ссылок на странице и известны после окончания итерации.
+    """
+
+    def __init__(self, path, encoding=None) -> None:
+        """
+        Args:
+            path (str): файл страницы
+            encoding (str, optional): кодировка страницы, иначе определяется парсером
+        """
+        self.path = path
+        self.encoding = encoding
+        self.author = None
+        self.title = None
+        self.depth = 0
+
+    @staticmethod
+    def is_book(element):
+        return 'book' in element.get('class', '').split()
+
+    @staticmethod
+    def drop(element):
+        """Освобождаем разобранный элемент и все предыдущие соседние
+        """
+        element.clear(keep_tail=True)
+        parent = element.getparent()
+        if parent is not None:
+            while element.getprevious() is not None:
+                del parent[0]
+
+    def read_link(self, element):
+        href = element.get('href', '')
+        if AUTHOR_HREF_RE.search(href):
+            self.author = element.xpath('string()')
+        elif BOOK_HREF_RE.search(href):
+            self.title = element.xpath('string()')
+
+    def handle(self, events):
+        """Разбираем очередную порцию событий парсера, отдаем законченные элементы book
+        """
+        for event, element in events:
+            if not isinstance(element.tag, str):
+                continue
+            if event == 'start':
+                if self.is_book(element):
+                    self.depth += 1
+            elif self.is_book(element):
+                self.depth -= 1
+                if self.depth == 0:
+                    yield element
+                    self.drop(element)
+            elif self.depth == 0:
+                if element.tag == 'a':
+                    self.read_link(element)
+                self.drop(element)
+
+    def __iter__(self):
+        parser = etree.HTMLPullParser(events=('start', 'end'), encoding=self.encoding)
+        self.depth = 0
+        with open(self.path, 'rb') as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                parser.feed(chunk)
+                yield from self.handle(parser.read_events())
+        parser.close()
+        yield from self.handle(parser.read_events())
@@ -1,28 +1,64 @@
 from aiogram import Bot, Dispatcher, executor, types
 from aiogram.dispatcher.filters import Text
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.utils.exceptions import BadRequest
 from catalog import Catalog
-from pdf_converter import PdfConverter
+from pdf_converter import PdfConverter, BookTooLarge
 from epub_converter import EpubConverter
+import pdf_converter as pdf_module
+import epub_converter as epub_module
 from notifer import Notifer
 from flibusta_logger import logger
-import json
+from http_client import http_client
+from conversion_pool import conversion_pool
+from conversion_queue import ConversionQueue, QueueFull, UserLimitExceeded, JobCancelled
+from catalog_store import book_id_from_link, BOOK_URL
+from callback_data import (encode, decode, time_to_index, index_to_time, PAGE, EPUB, PDF, CANCEL, FEED,
+                           FORMATS, NEW_BOOKS_SESSION, NO_SESSION, NO_TIME)
+from book_cache import book_cache
+from file_id_store import file_id_store
+from subscription_store import subscription_store
+from broadcast import broadcast
+from process_lock import FileLock
+from scheduler import scheduler
+from session_store import session_store
 import asyncio
+import datetime
+import glob
+from html import escape
+import re
 import os
-import shutil
-import aioschedule
+import secrets
 
 catalog = Catalog()
 pdf_converter = PdfConverter()
 epub_converter = EpubConverter()
 notifer = Notifer()
-
+conversion_queue = ConversionQueue(workers=conversion_pool.workers)
+
+
+# сколько самых подходящих книг показываем по одному запросу
+MAX_BOOKS = 30
+# как часто неведущий процесс проверяет, не пора ли ему стать ведущим, в секундах
+LEADER_POLL = 30
+# на сколько файлов блокировок раскладываются конвертации разных книг
+CONVERT_LOCK_SLOTS = 64
+# подсказок на одну страницу inline режима (не больше 50) и сколько секунд Telegram кеширует ответ
+INLINE_PAGE = 20
+INLINE_CACHE_TIME = 300
+# символы, которые нельзя использовать в имени файла
+FILE_NAME_RE = re.compile(r'[\\/:*?"<>|\n]')
+# название книги в тексте сообщения с книгой, см. render_book
+TITLE_RE = re.compile(r'^Название: (.+)$', re.M)
 
 bot_token = os.getenv("FLIBUSTA_BOT_TOKEN")
 if not bot_token:
     exit("Error: no token provided")
 
+# кому доступна команда /stats
+admin_id = int(os.getenv('FLIBUSTA_ADMIN_ID', '0'))
 bot = Bot(token=bot_token)
+leader_lock = FileLock('./files/leader.lock')
 dp = Dispatcher(bot)
 
 
@@ -40,6 +76,29 @@ async def help_command(msg: types.Message):
     await msg.answer('Просто отправь мне запрос и я покажу какие книжки есть в каталоге.\nМогу искать по автору, серии, названию книги. Так же могу искать по всему сразу например "Гарри Поттер Роулинг"\n\n<b>! Важный момент ! Если что-то сломалось не надо винить автора. Вините Роскомнадзор. Автор не виноват, что они против книжек.</b>', parse_mode='HTML')
 
 
+@dp.message_handler(commands=['stats'])
+async def stats_command(msg: types.Message):
+    '''Обработчик команды /stats: счетчики кешей поиска, рассылки за сегодня и последние запуски задач,
+    только для администратора
+    '''
+    if not admin_id or msg.from_user.id != admin_id:
+        return
+    stats = catalog.cache_stats()
+    lines = [f'Версия каталога: {stats["version"]}']
+    for name, title in (('queries', 'Запросы'), ('inline', 'Подсказки')):
+        cache = stats[name]
+        lines.append(f'{title}: записей {cache["size"]}, попаданий {cache["hits"]}, промахов {cache["misses"]}, '
+                     f'доля попаданий {cache["hit_rate"]:.0%}')
+    for progress in broadcast.progress():
+        state = 'завершена' if progress['finished'] else 'идет'
+        lines.append(f'Рассылка {progress["slot"]} ({state}): отправлено {progress["sent"]}, ошибок {progress["failed"]}, '
+                     f'заблокировали бота {progress["blocked"]}, {progress["rate"]:.1f} сообщений в секунду')
+    for name, started, duration, outcome, error in scheduler.last_runs():
+        started = datetime.datetime.fromtimestamp(started, scheduler.timezone).strftime('%d.%m %H:%M')
+        lines.append(f'{name}: {started}, {outcome} за {duration:.0f} с' + (f' ({error})' if error else ''))
+    await msg.answer('\n'.join(lines))
+
+
 @dp.message_handler(commands=['news'])
 async def news_feed(msg: types.Message):
     """Обработка команды /news, для подписки пользователя на получение обновлений
@@ -47,12 +106,12 @@ async def news_feed(msg: types.Message):
     Args:
         msg (types.Message): команда /news
     """
-    btn_9 = InlineKeyboardButton('09:00', callback_data=f'feed\n09:00')
-    btn_14 = InlineKeyboardButton('14:00', callback_data=f'feed\n14:00')
-    btn_18 = InlineKeyboardButton('18:00', callback_data=f'feed\n18:00')
-    btn_21 = InlineKeyboardButton('21:00', callback_data=f'feed\n21:00')
+    btn_9 = InlineKeyboardButton('09:00', callback_data=encode(FEED, index=time_to_index('09:00')))
+    btn_14 = InlineKeyboardButton('14:00', callback_data=encode(FEED, index=time_to_index('14:00')))
+    btn_18 = InlineKeyboardButton('18:00', callback_data=encode(FEED, index=time_to_index('18:00')))
+    btn_21 = InlineKeyboardButton('21:00', callback_data=encode(FEED, index=time_to_index('21:00')))
     btn_cancel = InlineKeyboardButton(
-        'Отписаться от рассылки', callback_data=f'feed\nNone')
+        'Отписаться от рассылки', callback_data=encode(FEED, index=NO_TIME))
     feed_menu = InlineKeyboardMarkup().add(btn_9, btn_14)
     feed_menu.add(btn_18, btn_21)
     feed_menu.add(btn_cancel)
@@ -67,9 +126,45 @@ async def random_book(msg: types.Message):
         msg (types.Message): команда /random
     """
     user_id = msg.from_user.id
+    # случайная книга не занимает сессию поиска, иначе вытесняла бы настоящие поиски пользователя;
+    # название для файла кнопки скачивания возьмут из текста сообщения
     random_book = await catalog.random_book()
+    if not random_book:
+        await msg.answer('Каталог еще загружается, попробуйте чуть позже.')
+        return
     await msg.answer('Вот вам что почитать случайного: ')
-    await show_book(user_id=user_id, books=random_book, index=0, book_source='random')
+    await show_book(user_id=user_id, books=random_book, index=0, book_source='random', session=NO_SESSION)
+
+
+def inline_result(book):
+    """Подсказка inline режима: книга с кнопками скачивания
+    """
+    book_link = book['book_link']
+    book_id = book_id_from_link(book_link)
+    author = ' '.join(name for name in (book['book_author_fn'], book['book_author_mn'], book['book_author_ln']) if name)
+    details = ', '.join(value for value in (author, book['book_series'], book['book_year']) if value)
+    text = (f'Автор: {escape(author)}\nНазвание: {escape(book["book_name"])}\nСерия: {escape(book["book_series"])}\n'
+            f'Год: {book["book_year"]} Язык: {book["book_lang"]}\n<a href="{book_link}">Посмотреть на сайте</a>')
+    menu = InlineKeyboardMarkup().add(
+        InlineKeyboardButton('Скачать EPUB', callback_data=encode(EPUB, book_id, NO_SESSION)),
+        InlineKeyboardButton('Скачать PDF', callback_data=encode(PDF, book_id, NO_SESSION)))
+    return types.InlineQueryResultArticle(
+        id=str(book_id), title=book['book_name'] or 'Без названия', description=details,
+        input_message_content=types.InputTextMessageContent(text, parse_mode='HTML'), reply_markup=menu)
+
+
+@dp.inline_handler()
+async def inline_search(inline_query: types.InlineQuery):
+    """Inline режим: подсказки книг по мере набора "@бот запрос" в любом чате.
+    Следующие страницы Telegram запрашивает сам по next_offset при прокрутке
+
+    Args:
+        inline_query (types.InlineQuery): набранный текст и смещение страницы
+    """
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    books, next_offset = catalog.inline_search(inline_query.query, offset, INLINE_PAGE)
+    await inline_query.answer([inline_result(book) for book in books], cache_time=INLINE_CACHE_TIME,
+                              next_offset=str(next_offset) if next_offset else '')
 
 
 @dp.message_handler(Text)
@@ -81,64 +176,62 @@ async def get_search_query(msg: types.Message):
     """
     user_id = msg.from_user.id
     query = msg.text
-    if os.path.exists(f'./files/{user_id}_query.json'):
-        os.remove(f'./files/{user_id}_query.json')
-        logger.debug(f'Файл: {user_id}_query.json удален')
-    books = await catalog.get_book_response(query=query, random_book=None)
-    await search_result_forming(user_id, books)
+    row_ids, total, corrected = await catalog.find_rows(query=query, limit=MAX_BOOKS)
+    books, session_id = [], NO_SESSION
+    if row_ids:
+        session = session_store.create(user_id, row_ids, catalog.book_ids(row_ids))
+        books, session_id = catalog.session_books(session.rows, session.book_ids) or [], session.session_id
+    if corrected:
+        await bot.send_message(user_id, f'По запросу "{query}" ничего нет, показываю результаты для "{corrected}".')
+    await search_result_forming(user_id, books, total, session_id)
 
 
 @dp.message_handler(Text)
-async def search_result_forming(user_id, books):
-    """В зависимости от количества книг в ответе выдаем результат пользователю.
-    Ограничение в 30 книг сделано для того чтобы не листать ответ пол часа.
+async def search_result_forming(user_id, books, total, session):
+    """Выдаем пользователю результат поиска. Если книг больше MAX_BOOKS, показываем самые подходящие
+    и сообщаем сколько примерно нашлось всего, чтобы было понятно что запрос стоит уточнить.
 
     Args:
         user_id (int): айди пользователя необходим для пересылки ответа
-        books (_type_): список книг из каталога
+        books (list): лучшие книги из каталога, от самой подходящей
+        total (int): примерное число всех найденых книг
+        session (int): сессия поиска для кнопок
     """
-    if len(books) > 30:
-        await bot.send_message(user_id, f'Слишком большое количество книг ({len(books)} шт.). Пожалуйста уточните запрос, а то вам будет сложно искать, а нам сложно печатать.')
-    elif len(books) == 0:
+    if len(books) == 0:
         await bot.send_message(user_id, 'Книг по данному запросу не найдено. Уточните вопрос, или если уверены в нем подпишитесь на обновления.Возможно книга появится позже.')
     else:
-        await save_books_to_json(user_id, books)
-        await show_book(user_id, books, index=0, book_source='query')
+        if total > len(books):
+            await bot.send_message(user_id, f'Найдено примерно {total} книг, вот {len(books)} самых подходящих. Если нужной нет - уточните запрос.')
+        await show_book(user_id, books, index=0, book_source='query', session=session)
 
 
-async def save_books_to_json(user_id, books):
-    """Сохраняем список книг запрошенные пользователем в json. У телеграм есть ограничение на размер данных для передачи в колбек кнопок.
+async def load_books(user_id, session_id):
+    """Список книг для перелистывания: поиск пользователя из памяти или новые книги
 
-    Args:
-        user_id (int): необходим для сохранения файла с ответом 
-        books (list): список словарей с книгами
+    Returns:
+        list: книги или None, если результат поиска устарел
     """
-    with open(f'./files/{user_id}_query.json', 'w') as file:
-        json.dump(books, file, ensure_ascii=False, indent=4)
-        logger.debug(
-            f'Файл с книжками которые запросил пользователь сохранен.Под именем - {user_id}_query.json')
+    if session_id == NEW_BOOKS_SESSION:
+        return await notifer.get_dif_books()
+    if session_id == NO_SESSION:
+        return None
+    session = session_store.get(user_id, session_id)
+    if session is None:
+        return None
+    return catalog.session_books(session.rows, session.book_ids)
 
 
-async def load_books_from_json(user_id):
-    '''
-    '''
-    with open(f'./files/{user_id}_query.json') as file:
-        books = json.load(file)
-        logger.debug(
-            'Список книг которые запросил пользователь успешно загружен из файла.')
-    return books
-
-
-@dp.message_handler(Text)
-async def show_book(user_id, books, index, book_source):
-    """Функция выводит одну книгу с информацией из списка книг по запросу пользователя.
-    Так же выводит кнопки вперед и назад в зависимости от индекса книги в списке.
-    Выводит кнопки скачивания EPUB и PDF.
+def render_book(books, index, book_source, session=NEW_BOOKS_SESSION):
+    """Текст и кнопки одной книги из списка книг по запросу пользователя.
+    Кнопки вперед и назад в зависимости от индекса книги в списке и кнопки скачивания EPUB и PDF.
 
     Args:
-        user_id (int): используется чтобы знать кому посылать ответ
         books (list): список ответа с книгами
         index (int): позиция конкретной книги в списке
+        session (int): сессия поиска, по ней кнопки находят список книг
+
+    Returns:
+        str, InlineKeyboardMarkup: текст сообщения и кнопки
     """
     book = books[index]
     try:
@@ -169,134 +262,241 @@ async def show_book(user_id, books, index, book_source):
         book_summary = book['book_summary']
     except:
         book_summary = 'Придется прочитать'
-    # опять таки ограничение телеграм, поэтому используется только первое слово из названия книги с ограничением до 10 символов
-    short_book_name = book_name.split(' ')[0][:10]
-    short_book_name = short_book_name.replace('.', '').replace(',', '')
-    btn_next = InlineKeyboardButton(
-        f'Книга ➡', callback_data=f'next\n{index}\n{book_source}')
-    btn_prev = InlineKeyboardButton(
-        '⬅ Книга', callback_data=f'prev\n{index}\n{book_source}')
+    book_id = book_id_from_link(book_link)
     btn_download_epub = InlineKeyboardButton(
-        'Скачать EPUB', callback_data=f'epub\n{book_link}\n{short_book_name}')
+        'Скачать EPUB', callback_data=encode(EPUB, book_id, session, index))
     btn_download_pdf = InlineKeyboardButton(
-        'Скачать PDF', callback_data=f'pdf\n{book_link}\n{short_book_name}')
+        'Скачать PDF', callback_data=encode(PDF, book_id, session, index))
+    # кнопки создаются только для существующих соседних книг: индекс в данных кнопки не бывает отрицательным
     buttons = []
-    if index == 0:
-        if len(books) == 1:
-            pass
-        else:
-            buttons.append(btn_next)
-    elif index == len(books) - 1:
-        buttons.append(btn_prev)
-    else:
-        buttons.append(btn_prev)
-        buttons.append(btn_next)
+    if index > 0:
+        buttons.append(InlineKeyboardButton(
+            '⬅ Книга', callback_data=encode(PAGE, session=session, index=index - 1)))
+    if index < len(books) - 1:
+        buttons.append(InlineKeyboardButton(
+            'Книга ➡', callback_data=encode(PAGE, session=session, index=index + 1)))
     menu = InlineKeyboardMarkup().add(*buttons)
     menu.add(btn_download_epub, btn_download_pdf)
     if book_source == 'query':
-        await bot.send_message(user_id, f'Найденые книги {index + 1} из {len(books)}\n\nАвтор: {author}\nНазвание: {book_name}\nСерия: {book_series}\nГод: {book_year} Язык: {book_lang}\n<a href="{book_link}">Посмотреть на сайте</a>', reply_markup=menu, parse_mode='HTML')
-    elif book_source == 'new' or book_source == 'random':
-        await bot.send_message(user_id, f'Новые книги на сайте {index + 1} из {len(books)}\n\nНазвание: {book_name}\nОписание: {book_summary}\n<a href="{book_link}">Посмотреть на сайте</a>', reply_markup=menu, parse_mode='HTML')
+        text = f'Найденые книги {index + 1} из {len(books)}\n\nАвтор: {author}\nНазвание: {book_name}\nСерия: {book_series}\nГод: {book_year} Язык: {book_lang}\n<a href="{book_link}">Посмотреть на сайте</a>'
+    else:
+        text = f'Новые книги на сайте {index + 1} из {len(books)}\n\nНазвание: {book_name}\nОписание: {book_summary}\n<a href="{book_link}">Посмотреть на сайте</a>'
+    return text, menu
 
 
-@dp.callback_query_handler(lambda c: 'next' in c.data)
-async def forward(callback_query: types.CallbackQuery):
-    """Обработка кнопки далее, для перехода по списку книг. 
-    После нажатия снова вызывается функция отображения книги, но уже с новым индексом +1 
+async def show_book(user_id, books, index, book_source, session=NEW_BOOKS_SESSION):
+    """Функция выводит одну книгу с информацией из списка книг по запросу пользователя.
 
     Args:
-        callback_query (types.CallbackQuery): просто передается индекс книги в списке
+        user_id (int): используется чтобы знать кому посылать ответ
+        books (list): список ответа с книгами
+        index (int): позиция конкретной книги в списке
+        session (int): сессия поиска для кнопок
     """
-    index = int(callback_query.data.split('\n')[1]) + 1
-    book_source = callback_query.data.split('\n')[2]
-    user_id = int(callback_query.from_user.id)
-    if book_source == 'query':
-        books = await load_books_from_json(user_id)
-    elif book_source == 'new':
-        books = await Notifer().get_dif_books()
-    await bot.delete_message(chat_id=callback_query.from_user.id, message_id=callback_query.message.message_id)
-    await show_book(user_id, books, index, book_source=book_source)
+    text, menu = render_book(books, index, book_source, session)
+    await bot.send_message(user_id, text, reply_markup=menu, parse_mode='HTML')
 
 
-@dp.callback_query_handler(lambda c: 'prev' in c.data)
-async def backward(callback_query: types.CallbackQuery):
-    """Обработка кнопки назад, для перехода по списку книг. 
-    После нажатия снова вызывается функция отображения книги, но уже с новым индексом -1 
+async def cancel_conversion(callback_query: types.CallbackQuery, callback):
+    """Отмена ожидания конвертации
 
     Args:
-        callback_query (types.CallbackQuery): просто передается индекс книги в списке
+        callback_query (types.CallbackQuery): нажатие кнопки
+        callback (Callback): id книги и формат в индексе
+    """
+    user_id = callback_query.from_user.id
+    key = (callback.book_id or None, FORMATS[callback.index])
+    if conversion_queue.cancel(user_id, key):
+        await bot.send_message(user_id, 'Скачивание отменено')
+    await bot.delete_message(chat_id=user_id, message_id=callback_query.message.message_id)
+
+
+async def turn_page(callback_query: types.CallbackQuery, callback):
+    """Обработка кнопок вперед и назад по списку книг: показываем книгу с индексом из кнопки
+
+    Args:
+        callback_query (types.CallbackQuery): нажатие кнопки
+        callback (Callback): сессия поиска и индекс книги
     """
-    index = int(callback_query.data.split('\n')[1]) - 1
-    book_source = callback_query.data.split('\n')[2]
     user_id = int(callback_query.from_user.id)
-    if book_source == 'query':
-        books = await load_books_from_json(user_id)
-    elif book_source == 'new':
-        books = await notifer.get_dif_books()
+    books = await load_books(user_id, callback.session)
     await bot.delete_message(chat_id=callback_query.from_user.id, message_id=callback_query.message.message_id)
-    await show_book(user_id, books, index, book_source=book_source)
+    if not books or callback.index >= len(books):
+        await bot.send_message(user_id, 'Результаты поиска устарели, повторите поиск.')
+        return
+    book_source = 'new' if callback.session == NEW_BOOKS_SESSION else 'query'
+    await show_book(user_id, books, callback.index, book_source=book_source, session=callback.session)
+
 
+async def download_book(callback_query: types.CallbackQuery, callback):
+    """Вызов конвертера в EPUB или PDF и отправка полученого файла пользователю.
+    Название книги для файла берется из списка книг, если он еще есть, для книги вне списка - из текста
+    сообщения с кнопкой, иначе файл называется по id книги
 
-@dp.callback_query_handler(lambda c: 'epub' in c.data)
-async def download_epub(callback_query: types.CallbackQuery):
-    """Вызов конвертера в EPUB и отправка полученого файла пользлвателю.
     Args:
-        callback_query (types.CallbackQuery): получаем ссылку на книгу которую надо скачать и ее название для сохранения файла
+        callback_query (types.CallbackQuery): нажатие кнопки
+        callback (Callback): id книги, сессия поиска и индекс книги
     """
     user_id = callback_query.from_user.id
-    book_link = callback_query.data.split('\n')[1]
-    book_name = callback_query.data.split('\n')[2].lower()
-    await bot.send_message(user_id, 'Скачиваем EPUB\nДождитесь окончания, это может занять какое-то время.')
+    if not callback.book_id:
+        await bot.send_message(user_id, 'К сожалению эта книга не доступна на сайте для скачивания. Поищите другую версию.')
+        return
+    book_link = f'{BOOK_URL}{callback.book_id}'
+    book_name = str(callback.book_id)
+    books = await load_books(user_id, callback.session)
+    if books and callback.index < len(books) and book_id_from_link(books[callback.index].get('book_link', '')) == callback.book_id:
+        book_name = FILE_NAME_RE.sub('', books[callback.index]['book_name'])[:100] or book_name
+    elif callback.session == NO_SESSION and callback_query.message and callback_query.message.text:
+        match = TITLE_RE.search(callback_query.message.text)
+        if match:
+            book_name = FILE_NAME_RE.sub('', match.group(1))[:100] or book_name
+    await convert_and_send(user_id, book_link, book_name, 'epub' if callback.action == EPUB else 'pdf')
+
+
+# версии конвертеров входят в ключ кеша готовых книг
+CONVERTER_VERSIONS = {'epub': epub_module.CONVERTER_VERSION, 'pdf': pdf_module.CONVERTER_VERSION}
+
+
+def remove_converted(path):
+    """Удаляем сконвертированный файл вне кеша, когда его получили все, кто ждал
+    """
+    if not path.startswith(book_cache.directory) and os.path.exists(path):
+        os.remove(path)
+
+
+async def convert_book(book_id, book_link, book_name, book_format):
+    """Конвертация одной книги для очереди. Файл называется по id книги, чтобы разные книги
+    с одинаковым коротким именем не перезаписывали друг друга, и сразу переносится в кеш книг
+
+    Returns:
+        str: путь до готового файла или None, если книги нет на сайте
+    """
+    if book_id is None:
+        return await run_converter(book_name, book_link, book_format)
+    # одну книгу в одном формате одновременно конвертирует только один процесс бота,
+    # остальные дожидаются и берут готовый файл из общего кеша книг
+    lock = FileLock(f'./files/locks/convert_{(book_id * 2 + FORMATS.index(book_format)) % CONVERT_LOCK_SLOTS}.lock')
+    await lock.wait()
     try:
-        book_name = epub_converter.make_epub(
-            short_book_name=book_name, book_link=book_link)
-        await bot.send_document(chat_id=user_id, document=open(f'./files/{book_name}.epub', 'rb'))
-    except Exception as error:
-        logger.warning(
-            f'Что то пошло не так с конвертацией EPUB и отправки пользователю. Данные:\nСсылка на неполучившуюся книгу:{book_link}\nНазвание книги: {book_name}\nАйди пользователя: {user_id}\nОшибка: {error}')
-        await bot.send_message(user_id, 'Извините что-то пошло не так. Мы работаем над проблемой.')
+        cached = await asyncio.to_thread(book_cache.get, book_id, book_format, CONVERTER_VERSIONS[book_format])
+        if cached is not None:
+            return cached
+        # у каждой попытки свое имя файла: после отмены рабочий процесс может еще дописывать
+        # и затем удалить файл прошлой попытки, пока новая конвертация той же книги уже идет
+        path = await run_converter(f'{book_id}_{secrets.token_hex(4)}', book_link, book_format)
+        if path is None:
+            return None
+        return await asyncio.to_thread(book_cache.put, book_id, book_format, CONVERTER_VERSIONS[book_format], path)
+    finally:
+        lock.release()
+
+
+async def run_converter(work_name, book_link, book_format):
+    """
+    Returns:
+        str: путь до сконвертированного файла или None, если книги нет на сайте
+    """
+    if book_format == 'epub':
+        result = await epub_converter.make_epub(short_book_name=work_name, book_link=book_link)
+    else:
+        result = await pdf_converter.make_pdf(book_name=work_name, book_link=book_link)
+    if result is None:
+        return None
+    return f'./files/{result}.{book_format}'
+
+
+async def send_book_file(user_id, path, book_name, book_format, book_id):
+    """Загружаем файл книги в Telegram и запоминаем file_id, чтобы дальше отправлять без загрузки
+    """
+    with open(path, 'rb') as document:
+        message = await bot.send_document(chat_id=user_id, document=types.InputFile(document, filename=f'{book_name}.{book_format}'))
+    if book_id is not None and message.document is not None:
+        file_id_store.set(book_id, book_format, CONVERTER_VERSIONS[book_format], message.document.file_id)
+
+
+async def send_known_file(user_id, book_id, book_format):
+    """Отправляем книгу по сохраненному file_id
+
+    Returns:
+        bool: удалось ли отправить. Если Telegram не принял file_id, он забывается
+    """
+    version = CONVERTER_VERSIONS[book_format]
+    file_id = file_id_store.get(book_id, book_format, version)
+    if file_id is None:
+        return False
     try:
-        os.remove(f'./files/{book_name}.epub')
-    except:
-        shutil.rmtree(f'./files/{book_name}/')
-        await bot.send_message(user_id, 'Похоже книга не доступна на сайте для скачивания. Попробуйте поискать другой вариант этой книги.')
+        await bot.send_document(chat_id=user_id, document=file_id)
+        return True
+    except BadRequest as error:
+        logger.warning(f'Telegram не принял file_id книги {book_id}.{book_format}, отправим файлом.\nОшибка: {error}')
+        file_id_store.forget(book_id, book_format, version)
+        return False
 
 
-@dp.callback_query_handler(lambda c: 'pdf' in c.data)
-async def download_pdf(callback_query: types.CallbackQuery):
-    """Вызов конвертера в PDF и отправка полученого файла пользлвателю.
+async def convert_and_send(user_id, book_link, book_name, book_format):
+    """Отправляем книгу по file_id, если она уже уходила в Telegram, иначе отдаем ее из кеша готовых книг,
+    а если нет и там - ставим конвертацию в общую очередь
+    и отправляем файл, когда он готов. Если эту же книгу в этом же формате уже конвертируют
+    для кого-то, ждем ту же конвертацию.
 
     Args:
-        callback_query (types.CallbackQuery): получаем ссылку на книгу которую надо скачать и ее название для сохранения файла
+        user_id (int): кому отправить книгу
+        book_link (str): ссылка на книгу
+        book_name (str): короткое имя книги для файла
+        book_format (str): 'epub' или 'pdf'
     """
-    user_id = callback_query.from_user.id
-    book_link = callback_query.data.split('\n')[1]
-    book_name = callback_query.data.split('\n')[2].lower()
-    await bot.send_message(user_id, 'Скачиваем PDF\nДождитесь окончания, это может занять какое-то время.')
-
+    book_id = book_id_from_link(book_link)
+    if book_id is not None:
+        try:
+            if await send_known_file(user_id, book_id, book_format):
+                return
+            cached = await asyncio.to_thread(book_cache.get, book_id, book_format, CONVERTER_VERSIONS[book_format])
+            if cached is not None:
+                await send_book_file(user_id, cached, book_name, book_format, book_id)
+                return
+        except Exception as error:
+            logger.warning(f'Не удалось отдать книгу {book_id}.{book_format} из кеша.\nОшибка: {error}')
+    try:
+        job, position = conversion_queue.submit(
+            user_id, (book_id, book_format), lambda: convert_book(book_id, book_link, book_name, book_format),
+            cleanup=remove_converted)
+    except UserLimitExceeded:
+        await bot.send_message(user_id, f'У вас уже {conversion_queue.per_user} книги в работе. Дождитесь их или отмените.')
+        return
+    except QueueFull:
+        await bot.send_message(user_id, 'Сейчас слишком много книг в работе. Попробуйте через пару минут.')
+        return
+    queue_text = f'\nВы {position}-й в очереди.' if position else ''
+    cancel_menu = InlineKeyboardMarkup().add(InlineKeyboardButton(
+        'Отменить', callback_data=encode(CANCEL, book_id, index=FORMATS.index(book_format))))
+    await bot.send_message(user_id, f'Скачиваем {book_format.upper()}\nДождитесь окончания, это может занять какое-то время.{queue_text}', reply_markup=cancel_menu)
     try:
-        book_name = pdf_converter.make_pdf(
-            book_name=book_name, book_link=book_link)
-        if book_name == None:
+        result = await conversion_queue.wait(job, user_id)
+        if result is None:
             await bot.send_message(user_id, 'К сожалению эта книга не доступна на сайте для скачивания. Поищите другую версию.')
-        await bot.send_document(chat_id=user_id, document=open(f'./files/{book_name}.pdf', 'rb'))
-        os.remove(f'./files/{book_name}.pdf')
+        else:
+            await send_book_file(user_id, result, book_name, book_format, book_id)
+    except JobCancelled:
+        pass
+    except BookTooLarge:
+        await bot.send_message(user_id, 'Эта книга слишком большая для PDF. Скачайте ее в EPUB.')
     except Exception as error:
         logger.warning(
-            f'Что то пошло не так с конвертацией PDF и отправки пользователю. Данные:\nСсылка на неполучившуюся книгу:{book_link}\nНазвание книги: {book_name}\nАйди пользователя: {user_id}\nОшибка: {error}')
-    await bot.send_message(user_id, 'Извините что-то пошло не так. Мы работаем над проблемой.')
-    os.remove(f'./files/{book_name}.epub')
+            f'Что то пошло не так с конвертацией {book_format.upper()} и отправки пользователю. Данные:\nСсылка на неполучившуюся книгу:{book_link}\nНазвание книги: {book_name}\nАйди пользователя: {user_id}\nОшибка: {error}')
+        await bot.send_message(user_id, 'Извините что-то пошло не так. Мы работаем над проблемой.')
+    finally:
+        conversion_queue.release(job, user_id)
 
 
-@dp.callback_query_handler(lambda c: 'feed' in c.data)
-async def set_notify_time(callback_query: types.CallbackQuery):
+async def set_notify_time(callback_query: types.CallbackQuery, callback):
     """Обрабатываем время в которое оповещать пользователя о новинках
 
     Args:
-        callback_query (types.CallbackQuery): получаем время уведомления
+        callback_query (types.CallbackQuery): нажатие кнопки
+        callback (Callback): время уведомления в минутах от начала суток в индексе
     """
     user_id = callback_query.from_user.id
-    notify_time = callback_query.data.split('\n')[1]
+    notify_time = index_to_time(callback.index)
     notifer.set_user_schedule(user_id=str(user_id), notify_time=notify_time)
     if notify_time == 'None':
         await bot.send_message(user_id, text='Вы отписались от обновлений')
@@ -305,44 +505,88 @@ async def set_notify_time(callback_query: types.CallbackQuery):
     await bot.delete_message(chat_id=callback_query.from_user.id, message_id=callback_query.message.message_id)
 
 
+CALLBACK_HANDLERS = {PAGE: turn_page, EPUB: download_book, PDF: download_book,
+                     CANCEL: cancel_conversion, FEED: set_notify_time}
+
+
+@dp.callback_query_handler()
+async def dispatch_callback(callback_query: types.CallbackQuery):
+    """Единая точка входа для всех кнопок: разбираем callback_data и вызываем обработчик действия
+    """
+    callback = decode(callback_query.data)
+    if callback is None:
+        await bot.send_message(callback_query.from_user.id, 'Эта кнопка устарела, повторите запрос.')
+        return
+    await CALLBACK_HANDLERS[callback.action](callback_query, callback)
+
+
 async def send_new_books(notify_time):
-    users = await notifer.get_user_id_to_send(notify_time=notify_time)
+    """Рассылка новых книг подписчикам времени notify_time. Сообщение собирается один раз на всю рассылку
+    """
     books = await notifer.get_dif_books()
     if books != []:
-        for user in users:
-            await show_book(user_id=user, books=books, index=0, book_source='new')
+        text, menu = render_book(books, 0, 'new')
     else:
-        for user in users:
-            await bot.send_message(user, 'Сегодня новых книг нет, но вы можете выбрать случайную командой "\\random"')
+        text, menu = 'Сегодня новых книг нет, но вы можете выбрать случайную командой "\\random"', None
+
+    async def send(user_id):
+        await bot.send_message(user_id, text, reply_markup=menu, parse_mode='HTML' if menu else None)
 
+    await broadcast.run(
+        notify_time, lambda after: subscription_store.users_for_slot(notify_time, after), send,
+        on_blocked=subscription_store.remove)
 
-async def scheduler():
-    # скачиваем новый каталог каждый день в 05:00
-    aioschedule.every().day.at('05:00').do(catalog.download_catalog_zip)
-    # распаковывываем новую версию каталога каждый день в 05:30 на всякий случай попозже
-    aioschedule.every().day.at('05:30').do(catalog.unzip_catalog)
+
+def schedule_jobs():
+    """Ежедневные задачи, время по МСК (FLIBUSTA_TIMEZONE)
+    """
+    # обновляем каталог каждый день в 05:00, распаковка и замена поиска - только если скачан новый архив
+    scheduler.add('download_catalog', catalog.download_catalog_zip, at=['05:00'])
+    scheduler.add('unzip_catalog', catalog.unzip_catalog, after='download_catalog')
     # проверяем RSS с новыми книгами каждый день в 8:00 утра
-    aioschedule.every().day.at('08:00').do(notifer.write_new_books_to_json)
+    scheduler.add('new_books', notifer.write_new_books_to_json, at=['08:00'])
     # новые книги
-    aioschedule.every().day.at('09:00').do(send_new_books, notify_time='09:00')
-    aioschedule.every().day.at('14:00').do(send_new_books, notify_time='14:00')
-    aioschedule.every().day.at('18:00').do(send_new_books, notify_time='18:00')
-    aioschedule.every().day.at('21:00').do(send_new_books, notify_time='21:00')
+    for notify_time in ('09:00', '14:00', '18:00', '21:00'):
+        scheduler.add(f'send_new_books_{notify_time}', send_new_books, at=[notify_time], args=(notify_time,))
     # удаляем файл с обновлениями, чтобы не машался
-    aioschedule.every().day.at('23:59').do(notifer.delete_diff_books)
+    scheduler.add('delete_diff_books', notifer.delete_diff_books, at=['23:59'])
 
-    while True:
-        await aioschedule.run_pending()
-        await asyncio.sleep(1)
+
+async def lead():
+    """Планировщик и рассылки работают только в одном процессе бота - ведущем, который держит leader_lock.
+    Остальные процессы (в режиме webhook с несколькими процессами) ждут, подхватывают каталог,
+    обновленный ведущим, и становятся ведущими, если ведущий процесс завершится
+    """
+    while not leader_lock.acquire():
+        await catalog.reload_if_changed()
+        await asyncio.sleep(LEADER_POLL)
+    logger.info(f'Процесс {os.getpid()} ведущий: планировщик и рассылки работают в нем')
+    # результаты поиска раньше хранились в файлах пользователей, теперь в session_store
+    for path in glob.glob('./files/*_query.json'):
+        os.remove(path)
+    # рассылки, прерванные перезапуском, продолжаются с места остановки
+    for notify_time in broadcast.unfinished():
+        asyncio.create_task(send_new_books(notify_time))
+    schedule_jobs()
+    await scheduler.run()
 
 
 async def on_startup(_):
-    if not os.path.exists('./files/'):
-        os.mkdir('./files/')
-        await catalog.download_catalog_zip()
-        await catalog.unzip_catalog()
-    asyncio.create_task(scheduler())
+    if not os.path.exists('./files/catalog.txt'):
+        os.makedirs('./files/', exist_ok=True)
+        # каталог скачивает ведущий процесс, остальные подхватят его в lead
+        if leader_lock.acquire():
+            await catalog.refresh_catalog()
+    if catalog.index is None:
+        # индекс строится в фоне, первый поиск дождется его готовности
+        asyncio.create_task(catalog.load_catalog())
+    asyncio.create_task(lead())
+
+
+async def on_shutdown(_):
+    await http_client.close()
+    conversion_pool.shutdown()
 
 if __name__ == '__main__':
 
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
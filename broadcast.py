@@ -0,0 +1,187 @@
+import asyncio
+import datetime
+import os
+import time
+import aiohttp
+from aiogram.utils.exceptions import (BotBlocked, ChatNotFound, NetworkError, RetryAfter,
+                                      TelegramAPIError, UserDeactivated)
+from flibusta_logger import logger
+from scheduler import scheduler
+from sqlite_store import SqliteStore, store_path
+
+
+class TokenBucket:
+    """Ограничитель частоты: не больше rate событий в секунду в среднем, всплесками до capacity
+    """
+
+    def __init__(self, rate, capacity=None) -> None:
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Telegram попросил подождать: забираем токены на seconds вперед, все отправки встают
+        """
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+        self.updated = time.monotonic()
+
+
+class Broadcast(SqliteStore):
+    """Рассылка одного сообщения всем подписчикам времени уведомления.
+    Общая частота отправки ограничена под лимит Telegram (около 30 сообщений в секунду на бота),
+    каждому пользователю уходит одно сообщение, так что лимит на один чат соблюдается сам собой.
+    На RetryAfter вся рассылка встает на указанное время, сетевые ошибки повторяются,
+    заблокировавшие бота пользователи отписываются. Прогресс сохраняется после каждой пачки
+    пользователей, после перезапуска бота рассылка продолжается с места остановки.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            day TEXT, slot TEXT, last_user INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0, finished INTEGER NOT NULL DEFAULT 0,
+            elapsed REAL NOT NULL DEFAULT 0, PRIMARY KEY (day, slot));'''
+
+    def __init__(self, path='./files/broadcasts.sqlite', rate=25, concurrency=20, retries=3) -> None:
+        """
+        Args:
+            path (str, optional): файл базы с прогрессом рассылок, None - в памяти процесса
+            rate (float): сообщений в секунду на весь бот
+            concurrency (int): одновременных запросов к Telegram
+            retries (int): сколько раз повторять отправку при сетевых ошибках и RetryAfter
+        """
+        super().__init__(path)
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.retries = retries
+
+
+    def opened(self, db):
+        columns = {row[1] for row in db.execute('PRAGMA table_info(broadcasts)')}
+        if 'elapsed' not in columns:
+            with db:
+                db.execute('ALTER TABLE broadcasts ADD COLUMN elapsed REAL NOT NULL DEFAULT 0')
+
+    @staticmethod
+    def today():
+        """Дата по часовому поясу расписания, а не сервера: времена рассылок заданы в нем
+        """
+        return datetime.datetime.now(scheduler.timezone).date().isoformat()
+
+    def unfinished(self, day=None):
+        """Рассылки за день, прерванные перезапуском
+
+        Returns:
+            list: времена уведомлений
+        """
+        return [row[0] for row in self.connect().execute(
+            'SELECT slot FROM broadcasts WHERE day = ? AND finished = 0', (day or self.today(),))]
+
+    def progress(self, day=None):
+        """Ход рассылок за день для /stats
+
+        Returns:
+            list: словари slot, sent, failed, blocked, finished, rate (сообщений в секунду)
+        """
+        rows = self.connect().execute(
+            'SELECT slot, sent, failed, blocked, finished, elapsed FROM broadcasts WHERE day = ? ORDER BY slot',
+            (day or self.today(),))
+        return [{'slot': slot, 'sent': sent, 'failed': failed, 'blocked': blocked, 'finished': bool(finished),
+                 'rate': (sent + failed + blocked) / elapsed if elapsed else 0.0}
+                for slot, sent, failed, blocked, finished, elapsed in rows]
+
+    async def deliver(self, send, user_id):
+        """Отправляем одному пользователю с повторами
+
+        Returns:
+            str: 'sent', 'blocked' или 'failed'
+        """
+        for attempt in range(self.retries + 1):
+            await self.bucket.acquire()
+            try:
+                await send(user_id)
+                return 'sent'
+            except RetryAfter as error:
+                logger.info(f'Telegram просит подождать {error.timeout} секунд, рассылка приостановлена')
+                self.bucket.pause(error.timeout)
+            except (BotBlocked, ChatNotFound, UserDeactivated):
+                return 'blocked'
+            except (NetworkError, aiohttp.ClientError, asyncio.TimeoutError) as error:
+                logger.debug(f'Не удалось отправить пользователю {user_id}, повторяем.\nОшибка: {error}')
+                await asyncio.sleep(2 ** attempt)
+            except TelegramAPIError as error:
+                logger.debug(f'Не удалось отправить пользователю {user_id}.\nОшибка: {error}')
+                return 'failed'
+        return 'failed'
+
+    async def run(self, slot, batches, send, on_blocked=None):
+        """Рассылаем сообщение
+
+        Args:
+            slot (str): время уведомления, вместе с датой определяет рассылку для сохранения прогресса
+            batches: функция (after) -> пачки id пользователей по возрастанию, начиная после after
+            send: корутинная функция (user_id), отправляющая сообщение
+            on_blocked (optional): вызывается с id пользователя, заблокировавшего бота
+
+        Returns:
+            dict: итоговые счетчики sent, failed, blocked
+        """
+        db = self.connect()
+        day = self.today()
+        row = db.execute('SELECT last_user, sent, failed, blocked, finished, elapsed FROM broadcasts '
+                         'WHERE day = ? AND slot = ?', (day, slot)).fetchone()
+        if row is None:
+            row = (0, 0, 0, 0, 0, 0.0)
+            with db:
+                db.execute('INSERT INTO broadcasts (day, slot) VALUES (?, ?)', (day, slot))
+        last_user, sent, failed, blocked, finished, elapsed_before = row
+        stats = {'sent': sent, 'failed': failed, 'blocked': blocked}
+        if finished:
+            logger.info(f'Рассылка {day} {slot} уже завершена')
+            return stats
+        if last_user:
+            logger.info(f'Рассылка {day} {slot} продолжается после пользователя {last_user}')
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.monotonic()
+        done = 0
+
+        async def deliver(user_id):
+            async with semaphore:
+                result = await self.deliver(send, user_id)
+            stats[result] += 1
+            if result == 'blocked' and on_blocked is not None:
+                on_blocked(user_id)
+
+        for batch in batches(last_user):
+            await asyncio.gather(*(deliver(user_id) for user_id in batch))
+            done += len(batch)
+            elapsed = time.monotonic() - started
+            # время копится по всем запускам рассылки, чтобы скорость в /stats считалась по всем отправкам
+            with db:
+                db.execute('UPDATE broadcasts SET last_user = ?, sent = ?, failed = ?, blocked = ?, elapsed = ? '
+                           'WHERE day = ? AND slot = ?',
+                           (batch[-1], stats['sent'], stats['failed'], stats['blocked'], elapsed_before + elapsed,
+                            day, slot))
+            logger.info(f'Рассылка {slot}: обработано {done}, отправлено {stats["sent"]}, ошибок {stats["failed"]}, '
+                        f'заблокировали бота {stats["blocked"]}, {done / elapsed if elapsed else 0:.1f} сообщений в секунду')
+        with db:
+            db.execute('UPDATE broadcasts SET finished = 1 WHERE day = ? AND slot = ?', (day, slot))
+        logger.info(f'Рассылка {day} {slot} завершена за {time.monotonic() - started:.0f} секунд: {stats}')
+        return stats
+
+
+broadcast = Broadcast(path=store_path('FLIBUSTA_BROADCAST_DB', './files/broadcasts.sqlite'),
+                      rate=float(os.getenv('FLIBUSTA_BROADCAST_RATE', '25')))
@@ -0,0 +1,64 @@
+import base64
+import binascii
+import struct
+from collections import namedtuple
+
+
+# действия кнопок
+PAGE, EPUB, PDF, CANCEL, FEED = range(1, 6)
+FORMATS = ('epub', 'pdf')
+# сессия 0 - список новых книг, NO_SESSION - книга вне какого-либо списка
+NEW_BOOKS_SESSION = 0
+NO_SESSION = 0xFFFFFFFF
+# индекс кнопки отписки от рассылки
+NO_TIME = 0xFFFF
+# действие, id книги, сессия поиска, индекс: 11 байт, 15 символов base64 вместо ссылки и названия книги
+LAYOUT = struct.Struct('>BIIH')
+
+Callback = namedtuple('Callback', 'action book_id session index')
+
+
+def encode(action, book_id=0, session=NEW_BOOKS_SESSION, index=0):
+    """Данные кнопки для callback_data
+
+    Args:
+        action (int): действие
+        book_id (int): id книги на флибусте, 0 если не нужен
+        session (int): сессия поиска пользователя
+        index (int): позиция книги в списке, формат для отмены или время рассылки в минутах
+
+    Returns:
+        str: строка до 64 байт
+    """
+    return base64.urlsafe_b64encode(LAYOUT.pack(action, book_id or 0, session, index)).rstrip(b'=').decode()
+
+
+def decode(data):
+    """Разбираем callback_data
+
+    Returns:
+        Callback: данные кнопки или None, если это кнопка старого формата или мусор
+    """
+    try:
+        raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+        callback = Callback(*LAYOUT.unpack(raw))
+    except (binascii.Error, struct.error, ValueError):
+        return None
+    if not PAGE <= callback.action <= FEED:
+        return None
+    return callback
+
+
+def time_to_index(notify_time):
+    """'09:00' -> минуты от начала суток, None или 'None' -> NO_TIME
+    """
+    if notify_time in (None, 'None'):
+        return NO_TIME
+    hours, minutes = notify_time.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def index_to_time(index):
+    if index == NO_TIME:
+        return 'None'
+    return f'{index // 60:02d}:{index % 60:02d}'
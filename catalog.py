@@ -1,10 +1,32 @@
 import aiohttp
+import asyncio
+import random
 import os
+import json
+import shutil
 from bs4 import BeautifulSoup
-import requests
 import zipfile
-import random
+from array import array
 from flibusta_logger import logger
+from http_client import http_client
+from summary_cache import summary_cache, NO_SUMMARY
+from ttl_cache import TTLCache
+from search_index import SearchIndex, tokenize
+from fuzzy_index import TrigramIndex
+from catalog_store import CatalogStore, CatalogFile, split_catalog_line, book_from_fields, diff_catalog, apply_delta, book_id_from_link
+
+
+CHUNK_SIZE = 64 * 1024
+# если удаленных строк в хранилище больше этой доли, каталог перестраивается целиком
+MAX_DEAD_SHARE = 0.25
+# сколько подсказок держать на один набранный текст в inline режиме
+INLINE_MAX = 100
+# сколько случайных строк пробовать, если попадаются неразбираемые
+RANDOM_ATTEMPTS = 5
+# сколько разных поисковых запросов помнить
+QUERY_CACHE_SIZE = int(os.getenv('FLIBUSTA_QUERY_CACHE_SIZE', '2048'))
+# минимальная похожесть слов для поиска с опечатками, от 0 до 1
+FUZZY_THRESHOLD = float(os.getenv('FLIBUSTA_FUZZY_THRESHOLD', '0.4'))
 
 
 class Catalog:
@@ -20,117 +42,422 @@ class Catalog:
         """
         self.catalog_url = 'https://www.flibusta.site/catalog/catalog.zip'
         self.query = query
+        self.catalog_file = None
+        self.store = None
+        self.index = None
+        self.fuzzy = None
+        self.index_lock = asyncio.Lock()
+        # изменения последнего обновления каталога, None если каталог грузился целиком
+        self.last_delta = None
+        # растет при каждой замене или обновлении каталога, входит в ключи кешей поиска,
+        # так что результаты по старому каталогу просто перестают находиться и вытесняются
+        self.version = 0
+        # время изменения catalog.txt, по которому построен каталог в памяти
+        self.loaded_mtime = None
+        # (версия, нормализованный запрос, limit) -> row id, примерное число найденых и исправленный запрос
+        self.query_cache = TTLCache(maxsize=QUERY_CACHE_SIZE, ttl=24 * 3600)
+        # (версия, набранный текст) -> row id подсказок inline режима
+        self.inline_cache = TTLCache(maxsize=4096, ttl=600)
 
-    async def download_catalog_zip(self):
-        """Скачиваем catalog.zip с flibusta.site
+    def load_catalog_meta(self):
+        """Читаем ETag и Last-Modified последнего скачанного каталога
+
+        Returns:
+            dict: заголовки прошлой загрузки или пустой словарь
         """
+        if not os.path.exists('./files/catalog.txt'):
+            return {}
         try:
-            response = requests.get(self.catalog_url)
-            logger.info(f'Код ответа: {response.status_code}')
-        except Exception as error:
-            logger.warning(
-                f'Не удалось сделать запрос к серверу с каталогом.\nОшибка: {error}')
+            with open('./files/catalog_meta.json', 'r') as file:
+                return json.load(file)
+        except Exception:
+            return {}
+
+    async def download_catalog_zip(self):
+        """Скачиваем catalog.zip с flibusta.site потоково, кусками прямо на диск.
+        Запрос условный: если каталог не менялся с прошлой загрузки, сервер отвечает 304 и архив не качается.
+        Ошибки скачивания пробрасываются, чтобы планировщик записал запуск как неудачный.
+
+        Returns:
+            bool: True если скачан новый архив, False если каталог не изменился
+        """
+        meta = self.load_catalog_meta()
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
         try:
-            with open('./files/catalog.zip', 'wb') as file:
-                file.write(response.content)
+            async with http_client.stream(self.catalog_url, headers=headers,
+                                          timeout=aiohttp.ClientTimeout(total=1800, sock_connect=15)) as response:
+                logger.info(f'Код ответа: {response.status}')
+                if response.status == 304:
+                    logger.debug('Каталог не изменился, скачивание пропущено')
+                    return False
+                response.raise_for_status()
+                with open('./files/catalog.zip.part', 'wb') as file:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        file.write(chunk)
+                meta = {'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified')}
+            os.replace('./files/catalog.zip.part', './files/catalog.zip')
+            # заголовки станут действующими только после успешной замены каталога в unzip_catalog,
+            # иначе после сбоя распаковки сервер ответил бы 304 и каталог бы больше не обновлялся
+            with open('./files/catalog_meta.json.new', 'w') as file:
+                json.dump(meta, file)
             logger.debug('Удалось сохранить каталог книг')
+            return True
         except Exception as error:
             logger.warning(
                 f'Не удалось получить каталог книг.\nОшибка: {error}')
+            if os.path.exists('./files/catalog.zip.part'):
+                os.remove('./files/catalog.zip.part')
+            raise
+
+    def extract_catalog(self, catalog_arch):
+        """Распаковываем catalog.txt рядом с рабочим файлом и подменяем его одной операцией,
+        чтобы читатели никогда не видели недописанный каталог
+        """
+        with zipfile.ZipFile(catalog_arch, 'r') as archive:
+            with archive.open('catalog.txt') as source, open('./files/catalog.txt.new', 'wb') as target:
+                shutil.copyfileobj(source, target, CHUNK_SIZE)
+        os.replace('./files/catalog.txt.new', './files/catalog.txt')
 
     async def unzip_catalog(self):
-        """Распаковка catalog.zip и удаление архива
+        """Распаковка catalog.zip в отдельном потоке, удаление архива и перестроение поиска.
+        ETag и Last-Modified нового архива сохраняются только после того, как новый каталог заменил старый.
+        Ошибки распаковки и перестроения пробрасываются, чтобы планировщик записал запуск как неудачный
         """
         catalog_arch = './files/catalog.zip'
+        new_meta = './files/catalog_meta.json.new'
+        try:
+            try:
+                await asyncio.to_thread(self.extract_catalog, catalog_arch)
+                logger.debug('Каталог книг успешно распакован')
+            except Exception as error:
+                logger.warning(
+                    f'Не удалось распаковать каталог с книгами\nОшибка: {error}')
+                raise
+            finally:
+                if os.path.exists(catalog_arch):
+                    os.remove(catalog_arch)
+                    logger.debug('Zip архив удален')
+            if self.store is None or not await self.update_catalog():
+                if not await self.load_catalog():
+                    raise RuntimeError('не удалось построить индекс нового каталога')
+        except BaseException:
+            # следующая загрузка будет без условных заголовков и скачает архив заново
+            if os.path.exists(new_meta):
+                os.remove(new_meta)
+            raise
+        if os.path.exists(new_meta):
+            os.replace(new_meta, './files/catalog_meta.json')
+
+    async def refresh_catalog(self):
+        """Полное обновление каталога: условное скачивание, распаковка и замена поиска.
+        Если каталог на сервере не менялся, ничего не перестраивается. Ошибки только пишутся в лог:
+        бот продолжает работать со старым каталогом.
+        """
+        try:
+            if await self.download_catalog_zip():
+                await self.unzip_catalog()
+        except Exception:
+            # причина уже записана в лог там, где произошла ошибка
+            pass
+
+    def build_catalog(self):
+        """Отображаем catalog.txt в память, разбираем его в колоночное хранилище и строим по нему индексы
+
+        Returns:
+            CatalogFile, CatalogStore, SearchIndex, TrigramIndex: файл, хранилище, поисковый и триграммный индексы
+        """
+        catalog_file = CatalogFile('./files/catalog.txt')
+        store = CatalogStore.from_file('./files/catalog.txt')
+        index = SearchIndex(store)
+        return catalog_file, store, index, TrigramIndex(index.tokens, FUZZY_THRESHOLD)
+
+    async def load_catalog(self):
+        """Загружаем каталог и строим поисковый индекс в отдельном потоке, чтобы не блокировать бота.
+        Новые структуры подменяют старые одним присваиванием: запросы видят либо старый каталог целиком, либо новый.
+        Вызывается при первом поиске и после каждой распаковки нового каталога.
+        Если каталог в памяти уже построен по текущему catalog.txt, ничего не перестраивается.
+
+        Returns:
+            bool: удалось ли построить каталог
+        """
+        async with self.index_lock:
+            mtime = self.catalog_mtime()
+            if self.index is not None and mtime is not None and mtime == self.loaded_mtime:
+                # каталог уже построил тот, кто ждал блокировку раньше: первые поиски во время
+                # загрузки при старте не должны перестраивать его еще по разу каждый
+                return True
+            try:
+                catalog_file, store, index, fuzzy = await asyncio.to_thread(self.build_catalog)
+            except Exception as error:
+                logger.warning(
+                    f'Не удалось построить индекс каталога.\nОшибка: {error}')
+                return False
+            old_file = self.catalog_file
+            self.catalog_file, self.store, self.index, self.fuzzy = catalog_file, store, index, fuzzy
+            self.last_delta = None
+            self.loaded_mtime = mtime
+            self.bump_version()
+            if old_file is not None:
+                old_file.close()
+            logger.debug('Поисковый индекс каталога построен')
+            return True
+
+    @staticmethod
+    def catalog_mtime():
         try:
-            with zipfile.ZipFile(catalog_arch, 'r') as file:
-                file.extract('catalog.txt', './files/')
-            logger.debug('Каталог книг успешно распакован')
+            return os.stat('./files/catalog.txt').st_mtime_ns
+        except OSError:
+            return None
+
+    async def reload_if_changed(self):
+        """Подхватываем catalog.txt, обновленный другим процессом бота: сначала пробуем накатить изменения,
+        если не получилось - загружаем каталог заново. Каталог, который еще не загружался, не трогаем,
+        он загрузится при первом поиске
+        """
+        mtime = self.catalog_mtime()
+        if self.store is None or mtime is None or mtime == self.loaded_mtime:
+            return
+        logger.info('catalog.txt изменен другим процессом, обновляем каталог')
+        if not await self.update_catalog():
+            await self.load_catalog()
+
+    def bump_version(self):
+        """Новая версия каталога. Статистика кешей за прошлую версию пишется в лог
+        """
+        if self.version:
+            logger.info(f'Кеши поиска за версию каталога {self.version}: {self.cache_stats()}')
+        self.version += 1
+
+    def cache_stats(self):
+        """Счетчики кешей поиска
+
+        Returns:
+            dict: статистика кеша запросов и кеша подсказок
+        """
+        return {'version': self.version, 'queries': self.query_cache.stats(), 'inline': self.inline_cache.stats()}
+
+    def build_delta(self):
+        """Сравниваем загруженный каталог с новым catalog.txt и отображаем новый файл в память
+
+        Returns:
+            CatalogFile, CatalogDelta: новый файл и изменения
+        """
+        delta = diff_catalog(self.store, './files/catalog.txt')
+        return CatalogFile('./files/catalog.txt'), delta
+
+    async def update_catalog(self):
+        """Накатываем на загруженный каталог только изменения нового catalog.txt.
+        Сравнение идет в отдельном потоке, а правка хранилища и индекса - одним синхронным куском,
+        так что запросы не видят половину изменений.
+
+        Returns:
+            bool: False если изменений слишком много и каталог надо перестроить целиком
+        """
+        async with self.index_lock:
+            mtime = self.catalog_mtime()
+            try:
+                catalog_file, delta = await asyncio.to_thread(self.build_delta)
+            except Exception as error:
+                logger.warning(
+                    f'Не удалось сравнить каталоги.\nОшибка: {error}')
+                return False
+            store = self.store
+            if (store.dead + len(delta.stale_rows)) > len(store) * MAX_DEAD_SHARE:
+                catalog_file.close()
+                return False
+            new_rows = apply_delta(store, delta)
+            self.fuzzy.add_tokens(self.index.add_rows(new_rows))
+            old_file, self.catalog_file = self.catalog_file, catalog_file
+            if old_file is not None:
+                old_file.close()
+            self.last_delta = delta
+            self.loaded_mtime = mtime
+            self.bump_version()
+            logger.debug(f'Каталог обновлен по изменениям: {delta}')
+            return True
+
+    def added_books(self):
+        """Книги, появившиеся в каталоге при последнем обновлении. Например, для рассылки подписчикам
+
+        Returns:
+            list: список словарей книг
+        """
+        if self.last_delta is None:
+            return []
+        return [book_from_fields(rows[0][0]) for rows in self.last_delta.added.values()]
+
+    async def open_catalog_file(self):
+        """Отображаем catalog.txt в память без построения поиска, нужно для /random до загрузки индекса
+        """
+        try:
+            self.catalog_file = await asyncio.to_thread(CatalogFile, './files/catalog.txt')
         except Exception as error:
             logger.warning(
-                f'Не удалось распаковать каталог с книгами\nОшибка: {error}')
-        if os.path.exists(catalog_arch):
-            os.remove(catalog_arch)
-            logger.debug('Zip архив удален')
+                f'Не удалось открыть каталог.\nОшибка: {error}')
+
+    async def find_rows(self, query, limit=30):
+        """Ранжированный поиск для пользователя: лучшие limit книг вместо отказа на общий запрос.
+        Если по запросу ничего нет, пробуем исправить опечатки по триграммному индексу.
+
+        Args:
+            query (str): запрос пользователя
+            limit (int): сколько книг вернуть
 
-    async def search_query(self, query):
-        """Поиск кинг по запросу пользователя
+        Returns:
+            list, int, str: номера строк от самой подходящей книги, примерное число всех найденых
+            и исправленный запрос, если искали по нему, иначе None
         """
-        answer = []
         try:
-            words = query.split(' ')
-            with open("./files/catalog.txt", "r") as file:
-                for line in file:
-                    for i in range(0, len(words)):
-                        if words[i].lower() not in line.lower():
-                            break
-                        else:
-                            if words[i].lower() == words[-1].lower() and words[i].lower() in line.lower():
-                                answer.append(line)
-            clear_answer = list(set(answer))
+            if self.index is None:
+                await self.load_catalog()
+            # порядок слов, регистр и пробелы на результат не влияют
+            key = (self.version, ' '.join(sorted(set(tokenize(query)))), limit)
+            cached = self.query_cache.get(key)
+            if cached is not None:
+                return cached
+            index, corrected = self.index, None
+            row_ids, total = index.ranked_search(query, limit)
+            if not row_ids:
+                for variant in index.correct_query(query, self.fuzzy):
+                    row_ids, total = index.ranked_search(variant, limit)
+                    if row_ids:
+                        corrected = variant
+                        break
             logger.debug(
-                f'Запрос выполнен успешно. Количество строк ответа {len(clear_answer)}')
+                f'Запрос выполнен успешно. Найдено примерно {total}, показано {len(row_ids)}')
         except Exception as error:
-            clear_answer = []
             logger.warning(f'Не удалось выполнить запрос.\nОшибка: {error}')
+            return [], 0, None
+        # пустой ответ тоже кешируется: повторный запрос не запускает заново исправление опечаток
+        result = tuple(row_ids), total, corrected
+        self.query_cache.set(key, result)
+
+        return result
+
+    async def find_books(self, query, limit=30):
+        """То же, что find_rows, но сразу со словарями книг
 
-        return clear_answer
+        Returns:
+            list, int, str: книги от самой подходящей, примерное число всех найденых и исправленный запрос
+        """
+        row_ids, total, corrected = await self.find_rows(query, limit)
+        return [self.store.book(row_id) for row_id in row_ids], total, corrected
 
-    async def get_book_response(self, query, random_book):
-        """Собираем ответ пользователя в словарь и отдаем пользователю.
+    def inline_search(self, query, offset=0, limit=20):
+        """Подсказки для inline режима по мере набора. Одинаковый набранный текст (после нормализации)
+        берется из кеша, страницы отдаются срезами одного и того же списка.
+        Если каталог еще не загружен, подсказок нет: ждать построения индекса inline запрос не может.
 
         Args:
-            random_book (list, optional): При поиске случайной книги. Defaults to None.
+            query (str): набранный текст
+            offset (int): сколько подсказок уже показано
+            limit (int): размер страницы
+
+        Returns:
+            list, int: книги страницы и смещение следующей страницы или None, если это последняя
+        """
+        index = self.index
+        text = ' '.join(tokenize(query))
+        if index is None or not text:
+            return [], None
+        key = (self.version, text)
+        rows = self.inline_cache.get(key)
+        if rows is None:
+            rows, seen = array('I'), set()
+            # книга с несколькими авторами занимает несколько строк, в подсказках она одна
+            for row_id in index.prefix_search(text, INLINE_MAX):
+                book_id = self.store.book_id[row_id]
+                if book_id not in seen:
+                    seen.add(book_id)
+                    rows.append(row_id)
+            self.inline_cache.set(key, rows)
+        end = offset + limit
+        return [self.store.book(row_id) for row_id in rows[offset:end]], end if end < len(rows) else None
+
+    def book_ids(self, row_ids):
+        """id книг на флибусте по номерам строк
+        """
+        return [self.store.book_id[row_id] for row_id in row_ids]
+
+    def session_books(self, rows, book_ids):
+        """Книги сохраненного поиска. Номера строк сверяются с id книг: после полной перестройки каталога
+        строки нумеруются заново, и старый поиск надо повторить
+
+        Returns:
+            list: книги или None, если номера строк устарели
+        """
+        store = self.store
+        if store is None:
+            return None
+        books = []
+        for row_id, book_id in zip(rows, book_ids):
+            if row_id >= len(store.book_id) or store.book_id[row_id] != book_id:
+                return None
+            books.append(store.book(row_id))
+        return books
+
+    async def get_book_response(self, random_book):
+        """Собираем книги из строк catalog.txt в словари с аннотацией для ответа пользователю.
+
+        Args:
+            random_book (list): строки каталога со случайными книгами
 
         Returns:
             list: Список книг с описанием
         """
         books = []
-        if random_book == None:
-            response = await self.search_query(query)
-        else:
-            response = random_book
-        for book in response:
-            book_data = book.split(';')
-            book_author_fn = f'{book_data[1]}'
-            book_author_ln = f'{book_data[0]}'
-            book_author_mn = f'{book_data[2]}'
-            book_name = f'{book_data[3]} {book_data[4]}'
-            book_lang = f'{book_data[5]}'
-            book_year = book_data[6]
-            book_series = book_data[7]
-            book_link = f'https://www.flibusta.site/b/{book_data[8]}'
-            if random_book:
-                book_summary = await self.get_book_summary(book_link)
-            else:
-                book_summary = ''
-            books.append({
-                'book_author_fn': book_author_fn.strip(),
-                'book_author_ln': book_author_ln.strip(),
-                'book_author_mn': book_author_mn.strip(),
-                'book_name': book_name.strip(),
-                'book_lang': book_lang.strip(),
-                'book_year': book_year.strip(),
-                'book_series': book_series.strip(),
-                'book_link': book_link.strip(),
-                'book_summary': book_summary
-            })
+        for line in random_book:
+            fields = split_catalog_line(line)
+            if fields is None:
+                continue
+            book = book_from_fields(fields)
+            book['book_summary'] = await self.get_book_summary(book['book_link'])
+            books.append(book)
 
         return books
 
-    async def random_book(self):
-        """Получаем случайную книгу из каталога
+    def random_row(self):
+        """Случайная живая строка загруженного каталога
 
         Returns:
-            list: информация о случайной книге
+            int: номер строки или None, если каталог еще не загружен
         """
-        with open('./files/catalog.txt', 'r') as file:
-            data = file.readlines()
+        store = self.store
+        if store is None or not len(store):
+            return None
+        for _ in range(10):
+            row_id = random.randrange(len(store))
+            if store.alive[row_id]:
+                return row_id
+        return None
 
-        random_book = [data[random.randint(1, len(data))]]
-        book_data = await self.get_book_response(query=None, random_book=random_book)
-        
-        return book_data
+    async def random_book(self):
+        """Получаем случайную книгу с аннотацией: из загруженного каталога, а пока он строится - прямо из catalog.txt
+
+        Returns:
+            list: информация о случайной книге, пустой если каталога нет или не нашлось ни одной целой строки
+        """
+        row_id = self.random_row()
+        if row_id is not None:
+            book = self.store.book(row_id)
+            book['book_summary'] = await self.get_book_summary(book['book_link'])
+            return [book]
+        if self.catalog_file is None:
+            await self.open_catalog_file()
+        catalog_file = self.catalog_file
+        if catalog_file is None or not len(catalog_file):
+            return []
+        # битые строки каталога не разбираются, берем другую
+        for _ in range(RANDOM_ATTEMPTS):
+            book_data = await self.get_book_response([catalog_file.random_line()])
+            if book_data:
+                return book_data
+        return []
 
     async def get_book_summary(self, book_url):
         """Получаем аннотацию о книге
@@ -141,20 +468,25 @@ class Catalog:
         Returns:
             str: аннотация
         """
+        book_id = book_id_from_link(book_url)
+        if book_id is not None:
+            summary = summary_cache.get(book_id)
+            if summary is not None:
+                return summary
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(book_url) as response:
-                    html = await response.text()
+            html = await http_client.get_text(book_url)
 
             soup = BeautifulSoup(html, 'lxml')
             summary = soup.find('h2').find_next().text
             if 'поиск' in summary:
-                summary = 'отсутствует'
+                summary = NO_SUMMARY
             logger.debug(
                 f'Удалось получить информацию о книге по ссылке: {book_url}')
         except Exception as error:
             summary  = ''
             logger.warning(
                 f'Не удалось получить инфо о книге.\nURL =  {book_url}.\nОшибка: {error}')
+        if book_id is not None:
+            summary_cache.set(book_id, summary)
 
         return summary
@@ -0,0 +1,361 @@
+import mmap
+import random
+import re
+from array import array
+from flibusta_logger import logger
+
+
+BOOK_URL = 'https://www.flibusta.site/b/'
+BOOK_ID_RE = re.compile(r'/b/(\d+)')
+
+
+def book_id_from_link(book_link):
+    """id книги из ссылки вида https://www.flibusta.site/b/123
+
+    Returns:
+        int: id книги или None
+    """
+    match = BOOK_ID_RE.search(book_link)
+    return int(match.group(1)) if match else None
+
+
+def split_catalog_line(line):
+    """Разбираем строку catalog.txt на поля
+
+    Args:
+        line (str): строка каталога вида "фамилия;имя;отчество;название;подзаголовок;язык;год;серия;id"
+
+    Returns:
+        list: список из 9 очищенных полей или None если строка битая
+    """
+    fields = line.rstrip('\n').split(';')
+    if len(fields) < 9 or not fields[8].strip().isdigit():
+        return None
+    return [field.strip() for field in fields[:9]]
+
+
+def line_digest(line):
+    """Хеш строки каталога для поиска изменившихся книг. Живет только в памяти текущего процесса
+    """
+    return hash(line.rstrip('\n'))
+
+
+def book_from_fields(fields):
+    """Собираем словарь книги в том виде, в котором его ждет бот
+
+    Args:
+        fields (list): поля строки каталога после split_catalog_line
+
+    Returns:
+        dict: данные книги
+    """
+    return {
+        'book_author_fn': fields[1],
+        'book_author_ln': fields[0],
+        'book_author_mn': fields[2],
+        'book_name': f'{fields[3]} {fields[4]}'.strip(),
+        'book_lang': fields[5],
+        'book_year': fields[6],
+        'book_series': fields[7],
+        'book_link': f'{BOOK_URL}{fields[8]}',
+        'book_summary': ''
+    }
+
+
+class StringTable:
+    """Словарь повторяющихся строк (авторы, серии, языки): в колонке хранится только номер строки
+    """
+
+    def __init__(self) -> None:
+        self.values = ['']
+        self.codes = {'': 0}
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class CatalogStore:
+    """Каталог, разобранный один раз при загрузке и уложенный по колонкам.
+    Повторяющиеся строки хранятся в словарях, id книг и годы - в массивах чисел,
+    названия - одной склеенной строкой со смещениями. Номер строки (row id) - индекс в колонках.
+    """
+
+    def __init__(self) -> None:
+        self.names = StringTable()
+        self.langs = StringTable()
+        self.series = StringTable()
+        self.author_ln = array('I')
+        self.author_fn = array('I')
+        self.author_mn = array('I')
+        self.lang = array('I')
+        self.series_code = array('I')
+        self.year = array('H')
+        self.book_id = array('I')
+        self.title_offsets = array('I', [0])
+        self.title_parts = []
+        self.titles = ''
+        # хеш исходной строки нужен для сравнения с новым каталогом, alive - для удаления без перестройки колонок
+        self.digest = array('q')
+        self.alive = bytearray()
+        self.dead = 0
+
+    def __len__(self):
+        return len(self.book_id)
+
+    def append(self, fields, digest=0):
+        """Добавляем разобранную строку каталога в колонки
+
+        Args:
+            fields (list): поля строки после split_catalog_line
+            digest (int): хеш исходной строки, см. line_digest
+
+        Returns:
+            int: row id добавленной строки
+        """
+        self.author_ln.append(self.names.code(fields[0]))
+        self.author_fn.append(self.names.code(fields[1]))
+        self.author_mn.append(self.names.code(fields[2]))
+        self.lang.append(self.langs.code(fields[5]))
+        self.series_code.append(self.series.code(fields[7]))
+        year = fields[6]
+        # нечисловой или пустой год хранится как 0 и показывается как пустая строка
+        self.year.append(int(year) if year.isdigit() and int(year) < 65536 else 0)
+        self.book_id.append(int(fields[8]))
+        title = f'{fields[3]} {fields[4]}'.strip()
+        self.title_parts.append(title)
+        self.title_offsets.append(self.title_offsets[-1] + len(title))
+        self.digest.append(digest)
+        self.alive.append(1)
+        return len(self.book_id) - 1
+
+    def remove(self, row_id):
+        """Помечаем строку удаленной. Данные остаются на месте до полной перестройки каталога
+        """
+        if self.alive[row_id]:
+            self.alive[row_id] = 0
+            self.dead += 1
+
+    def seal(self):
+        """Склеиваем накопленные названия в одну строку, после этого хранилище готово к чтению
+        """
+        if self.title_parts:
+            self.titles += ''.join(self.title_parts)
+            self.title_parts = []
+
+    @classmethod
+    def from_file(cls, path):
+        """Читаем catalog.txt построчно и раскладываем по колонкам. Первая строка - заголовок.
+
+        Args:
+            path (str): путь до catalog.txt
+
+        Returns:
+            CatalogStore: заполненное хранилище
+        """
+        store = cls()
+        skipped = 0
+        with open(path, 'r') as file:
+            file.readline()
+            for line in file:
+                fields = split_catalog_line(line)
+                if fields is None:
+                    skipped += 1
+                    continue
+                store.append(fields, line_digest(line))
+        store.seal()
+        logger.debug(
+            f'Каталог загружен. Строк: {len(store)}, пропущено битых: {skipped}')
+
+        return store
+
+    def title(self, row_id):
+        return self.titles[self.title_offsets[row_id]:self.title_offsets[row_id + 1]]
+
+    def row_text(self, row_id):
+        """Текст строки для индексации: те же поля, что были в исходной строке каталога
+        """
+        names = self.names.values
+        year = self.year[row_id]
+        return ';'.join((
+            names[self.author_ln[row_id]],
+            names[self.author_fn[row_id]],
+            names[self.author_mn[row_id]],
+            self.title(row_id),
+            self.langs.values[self.lang[row_id]],
+            str(year) if year else '',
+            self.series.values[self.series_code[row_id]],
+            str(self.book_id[row_id])))
+
+    def search_fields(self, row_id):
+        """Поля строки, по которым ранжируется поиск
+
+        Returns:
+            tuple: (автор, название, серия, остальное: язык, год и id)
+        """
+        names = self.names.values
+        author = ' '.join((names[self.author_ln[row_id]], names[self.author_fn[row_id]], names[self.author_mn[row_id]]))
+        year = self.year[row_id]
+        rest = ' '.join((self.langs.values[self.lang[row_id]], str(year) if year else '', str(self.book_id[row_id])))
+        return author, self.title(row_id), self.series.values[self.series_code[row_id]], rest
+
+    def book(self, row_id):
+        """Словарь книги по номеру строки, без повторного разбора текста
+
+        Returns:
+            dict: данные книги в формате book_from_fields
+        """
+        names = self.names.values
+        year = self.year[row_id]
+        return {
+            'book_author_fn': names[self.author_fn[row_id]],
+            'book_author_ln': names[self.author_ln[row_id]],
+            'book_author_mn': names[self.author_mn[row_id]],
+            'book_name': self.title(row_id),
+            'book_lang': self.langs.values[self.lang[row_id]],
+            'book_year': str(year) if year else '',
+            'book_series': self.series.values[self.series_code[row_id]],
+            'book_link': f'{BOOK_URL}{self.book_id[row_id]}',
+            'book_summary': ''
+        }
+
+
+class CatalogDelta:
+    """Разница между загруженным каталогом и новым catalog.txt по id книги (поле 8).
+    Книга с несколькими авторами занимает несколько строк, поэтому у книги - список строк.
+    """
+
+    def __init__(self, added, removed, changed, stale_rows) -> None:
+        """
+        Args:
+            added (dict): id новой книги -> список (поля, хеш) ее строк
+            removed (set): id книг, которых больше нет в каталоге
+            changed (dict): id изменившейся книги -> список (поля, хеш) новых строк
+            stale_rows (list): row id старых строк удаленных и изменившихся книг
+        """
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        self.stale_rows = stale_rows
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    def __repr__(self):
+        return f'CatalogDelta(added={len(self.added)}, removed={len(self.removed)}, changed={len(self.changed)})'
+
+
+def book_digests(store):
+    """Сводный хеш всех живых строк каждой книги загруженного каталога
+    """
+    digests = {}
+    alive = store.alive
+    for row_id, book_id in enumerate(store.book_id):
+        if alive[row_id]:
+            digests[book_id] = digests.get(book_id, 0) + store.digest[row_id]
+    return digests
+
+
+def diff_catalog(store, path):
+    """Сравниваем загруженный каталог с новым файлом. Первый проход считает хеши книг нового файла,
+    второй разбирает только строки добавленных и изменившихся книг, так что память
+    под новые данные растет с размером изменений, а не каталога.
+
+    Args:
+        store (CatalogStore): загруженный каталог
+        path (str): путь до нового catalog.txt
+
+    Returns:
+        CatalogDelta: изменения
+    """
+    old_digests = book_digests(store)
+    new_digests = {}
+    with open(path, 'r') as file:
+        file.readline()
+        for line in file:
+            fields = line.split(';', 9)
+            if len(fields) < 9 or not fields[8].strip().isdigit():
+                continue
+            book_id = int(fields[8])
+            new_digests[book_id] = new_digests.get(book_id, 0) + line_digest(line)
+    removed = old_digests.keys() - new_digests.keys()
+    changed_ids = {book_id for book_id, digest in new_digests.items()
+                   if book_id in old_digests and old_digests[book_id] != digest}
+    wanted = (new_digests.keys() - old_digests.keys()) | changed_ids
+    del old_digests, new_digests
+    added, changed = {}, {}
+    if wanted:
+        with open(path, 'r') as file:
+            file.readline()
+            for line in file:
+                fields = split_catalog_line(line)
+                if fields is None or int(fields[8]) not in wanted:
+                    continue
+                book_id = int(fields[8])
+                target = changed if book_id in changed_ids else added
+                target.setdefault(book_id, []).append((fields, line_digest(line)))
+    stale_ids = removed | changed_ids
+    stale_rows = [row_id for row_id, book_id in enumerate(store.book_id)
+                  if store.alive[row_id] and book_id in stale_ids] if stale_ids else []
+
+    return CatalogDelta(added, removed, changed, stale_rows)
+
+
+def apply_delta(store, delta):
+    """Накатываем изменения на хранилище: старые строки помечаем удаленными, новые дописываем в конец
+
+    Returns:
+        list: row id добавленных строк
+    """
+    for row_id in delta.stale_rows:
+        store.remove(row_id)
+    new_rows = []
+    for rows in (delta.added, delta.changed):
+        for book_rows in rows.values():
+            for fields, digest in book_rows:
+                new_rows.append(store.append(fields, digest))
+    store.seal()
+
+    return new_rows
+
+
+class CatalogFile:
+    """catalog.txt, отображенный в память, и индекс смещений начала строк.
+    Позволяет достать любую строку по номеру без чтения файла в список.
+    Номер строки считается без заголовка.
+    """
+
+    def __init__(self, path) -> None:
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = array('Q')
+        size = len(self.map)
+        position = self.map.find(b'\n') + 1
+        while 0 < position < size:
+            self.offsets.append(position)
+            position = self.map.find(b'\n', position) + 1
+        # смещение конца последней строки, чтобы line() не проверял границы
+        self.offsets.append(size)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def line(self, row_id):
+        """Строка каталога по номеру
+
+        Returns:
+            str: строка каталога
+        """
+        return self.map[self.offsets[row_id]:self.offsets[row_id + 1]].decode('utf-8', errors='replace')
+
+    def random_line(self):
+        """Случайная строка каталога, заголовок не попадает
+        """
+        return self.line(random.randrange(len(self)))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
@@ -0,0 +1,96 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from flibusta_logger import logger
+
+
+class ConversionTimeout(Exception):
+    """Конвертация не уложилась в отведенное время"""
+
+
+class ConversionPool:
+    """Пул процессов для конвертации книг. Разбор HTML, сборка EPUB и WeasyPrint работают в отдельных
+    процессах, поэтому бот не замирает на время конвертации, а несколько книг конвертируются
+    параллельно на разных ядрах.
+    """
+
+    def __init__(self, workers=None, timeout=300) -> None:
+        """
+        Args:
+            workers (int, optional): число процессов, по умолчанию по числу ядер
+            timeout (float): сколько секунд ждать одну конвертацию
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.executor = None
+
+    def get_executor(self):
+        """Процессы запускаются при первой конвертации. Используется spawn, а не fork,
+        чтобы не копировать в рабочие процессы цикл событий и открытые соединения бота
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self.executor
+
+    async def run(self, func, *args, timeout=None, discard=None):
+        """Выполняем func(*args) в рабочем процессе и ждем результат
+
+        Args:
+            func: функция уровня модуля, ее и аргументы должно быть можно передать в другой процесс
+            timeout (float, optional): таймаут вместо общего
+            discard (optional): вызывается с результатом func, если ожидание отменили, а рабочий процесс
+                все равно довел работу до конца, например чтобы удалить никому не нужный файл
+
+        Raises:
+            ConversionTimeout: если конвертация не уложилась во время
+
+        Returns:
+            результат func
+        """
+        job = self.get_executor().submit(func, *args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(job), timeout or self.timeout)
+        except asyncio.CancelledError:
+            # запущенную задачу пул не прерывает, ее результат убираем, когда процесс закончит
+            if discard is not None:
+                job.add_done_callback(lambda done: self.discard(done, discard))
+            raise
+        except asyncio.TimeoutError:
+            logger.warning(
+                f'Конвертация не уложилась в {timeout or self.timeout} секунд, пул процессов перезапускается')
+            self.restart()
+            raise ConversionTimeout()
+
+    @staticmethod
+    def discard(done, discard):
+        if done.cancelled() or done.exception() is not None or done.result() is None:
+            return
+        try:
+            discard(done.result())
+        except Exception as error:
+            logger.warning(f'Не удалось убрать результат отмененной конвертации.\nОшибка: {error}')
+
+    def restart(self):
+        """Останавливаем зависшие процессы. Пул процессов не умеет отменять запущенную задачу,
+        поэтому процессы завершаются принудительно, а следующая конвертация создаст новый пул.
+        Остальные конвертации, шедшие в этом пуле, тоже завершатся ошибкой.
+        """
+        executor, self.executor = self.executor, None
+        if executor is None:
+            return
+        processes = list(getattr(executor, '_processes', {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+conversion_pool = ConversionPool(
+    workers=int(os.getenv('FLIBUSTA_CONVERT_WORKERS', '0')) or None,
+    timeout=float(os.getenv('FLIBUSTA_CONVERT_TIMEOUT', '300')))
@@ -0,0 +1,192 @@
+import asyncio
+from collections import deque
+from flibusta_logger import logger
+
+
+class QueueFull(Exception):
+    """Очередь конвертации заполнена"""
+
+
+class UserLimitExceeded(Exception):
+    """У пользователя уже слишком много конвертаций в работе"""
+
+
+class JobCancelled(Exception):
+    """Пользователь отменил ожидание конвертации"""
+
+
+class ConversionJob:
+    """Одна конвертация (id книги, формат) и все пользователи, которые ждут ее результат
+    """
+
+    def __init__(self, key, factory, cleanup=None) -> None:
+        """
+        Args:
+            key (tuple): (id книги, формат)
+            factory: функция без аргументов, возвращающая корутину конвертации
+            cleanup (optional): вызывается с результатом, когда его забрали все ожидающие
+        """
+        self.key = key
+        self.factory = factory
+        self.cleanup = cleanup
+        self.waiters = {}
+        self.task = None
+        self.finished = False
+        self.result = None
+
+
+class ConversionQueue:
+    """Планировщик конвертаций.
+    Одинаковые запросы (id книги, формат), которые уже в очереди или в работе, объединяются в одну
+    конвертацию, результат получают все ожидающие. Одновременно выполняется не больше workers
+    конвертаций, у одного пользователя не больше per_user ожидающих конвертаций, очередь ограничена
+    max_queue. Ожидание можно отменить; конвертация, которую больше никто не ждет, снимается.
+    """
+
+    def __init__(self, workers=2, max_queue=50, per_user=2) -> None:
+        self.workers = workers
+        self.max_queue = max_queue
+        self.per_user = per_user
+        self.jobs = {}
+        self.pending = deque()
+        self.running = set()
+        self.user_jobs = {}
+
+    def position(self, job):
+        """Место конвертации в очереди, 0 - уже выполняется
+        """
+        try:
+            return self.pending.index(job) + 1
+        except ValueError:
+            return 0
+
+    def submit(self, user_id, key, factory, cleanup=None):
+        """Ставим конвертацию в очередь или присоединяемся к уже существующей
+
+        Args:
+            user_id (int): кто ждет результат
+            key (tuple): (id книги, формат)
+            factory: функция без аргументов, возвращающая корутину конвертации
+            cleanup (optional): вызывается с результатом, когда его забрали все ожидающие
+
+        Raises:
+            UserLimitExceeded: у пользователя уже per_user конвертаций
+            QueueFull: очередь заполнена
+
+        Returns:
+            ConversionJob, int: конвертация и место в очереди (0 - уже выполняется)
+        """
+        job = self.jobs.get(key)
+        if job is not None and user_id in job.waiters:
+            return job, self.position(job)
+        user_keys = self.user_jobs.setdefault(user_id, set())
+        if len(user_keys) >= self.per_user:
+            raise UserLimitExceeded()
+        if job is None:
+            if len(self.pending) >= self.max_queue:
+                raise QueueFull()
+            job = self.jobs[key] = ConversionJob(key, factory, cleanup)
+            self.pending.append(job)
+        else:
+            logger.debug(f'Конвертация {key} уже в работе, пользователь {user_id} ждет ее результат')
+        job.waiters[user_id] = asyncio.get_running_loop().create_future()
+        user_keys.add(key)
+        self.dispatch()
+
+        return job, self.position(job)
+
+    def dispatch(self):
+        """Запускаем конвертации из очереди, пока есть свободные места
+        """
+        while self.pending and len(self.running) < self.workers:
+            job = self.pending.popleft()
+            job.task = asyncio.create_task(job.factory())
+            job.task.add_done_callback(lambda task, job=job: self.finish(job, task))
+            self.running.add(job)
+
+    def finish(self, job, task):
+        """Раздаем результат всем ожидающим и запускаем следующие конвертации
+        """
+        self.running.discard(job)
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+        job.finished = True
+        if task.cancelled():
+            # снятая конвертация: кто успел присоединиться к ней после отмены, тоже получает отказ
+            for user_id in list(job.waiters):
+                waiter = job.waiters[user_id]
+                if not waiter.done():
+                    waiter.set_exception(JobCancelled())
+                    waiter.exception()
+                self.release(job, user_id)
+        else:
+            error = task.exception()
+            job.result = None if error else task.result()
+            for waiter in job.waiters.values():
+                if waiter.done():
+                    continue
+                if error:
+                    waiter.set_exception(error)
+                else:
+                    waiter.set_result(job.result)
+        self.release_if_done(job)
+        self.dispatch()
+
+    async def wait(self, job, user_id):
+        """Ждем результат конвертации
+
+        Raises:
+            JobCancelled: если пользователь отменил ожидание
+
+        Returns:
+            результат конвертации
+        """
+        waiter = job.waiters.get(user_id)
+        if waiter is None:
+            raise JobCancelled()
+        return await waiter
+
+    def cancel(self, user_id, key):
+        """Отменяем ожидание пользователя. Если конвертацию больше никто не ждет, она снимается
+
+        Returns:
+            bool: было ли что отменять
+        """
+        job = self.jobs.get(key)
+        if job is None or user_id not in job.waiters:
+            return False
+        waiter = job.waiters[user_id]
+        if not waiter.done():
+            waiter.set_exception(JobCancelled())
+            # ожидание могло еще не начаться, отмечаем исключение полученным, чтобы asyncio не ругался
+            waiter.exception()
+        self.release(job, user_id)
+        if not job.waiters:
+            if job in self.pending:
+                self.pending.remove(job)
+                self.jobs.pop(key, None)
+            elif job.task is not None:
+                # новый запрос той же книги не должен присоединиться к снимаемой конвертации
+                self.jobs.pop(key, None)
+                job.task.cancel()
+            logger.debug(f'Конвертация {key} снята, ее больше никто не ждет')
+        return True
+
+    def release(self, job, user_id):
+        """Пользователь забрал результат (или отказался от него)
+        """
+        job.waiters.pop(user_id, None)
+        user_keys = self.user_jobs.get(user_id)
+        if user_keys is not None:
+            user_keys.discard(job.key)
+            if not user_keys:
+                del self.user_jobs[user_id]
+        self.release_if_done(job)
+
+    def release_if_done(self, job):
+        if job.finished and not job.waiters and job.cleanup is not None and job.result is not None:
+            try:
+                job.cleanup(job.result)
+            except Exception as error:
+                logger.warning(f'Не удалось убрать результат конвертации {job.key}.\nОшибка: {error}')
+            job.cleanup = None
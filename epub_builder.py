@@ -0,0 +1,115 @@
+import zipfile
+from html import escape
+
+
+CONTAINER_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+'''
+
+CHAPTER_HEAD = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"/><title>{title}</title></head>
+<body>
+'''
+
+CHAPTER_TAIL = '''
+</body>
+</html>
+'''
+
+
+class EpubBuilder:
+    """Пишет EPUB 2 прямо в zip по мере разбора книги: каждая глава уходит в архив, как только
+    закончилась, без промежуточных файлов. Оглавление и манифест дописываются при закрытии.
+    """
+
+    def __init__(self, target, title, author, identifier, language='ru') -> None:
+        """
+        Args:
+            target: путь до файла или открытый на запись файловый объект
+            title (str): название книги
+            author (str): автор
+            identifier (str): уникальный идентификатор книги, например ссылка на нее
+            language (str): язык книги
+        """
+        self.title = title
+        self.author = author
+        self.identifier = identifier
+        self.language = language
+        self.chapters = []
+        self.stream = None
+        self.archive = zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED)
+        # mimetype должен идти первым и без сжатия
+        self.archive.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self.archive.writestr('META-INF/container.xml', CONTAINER_XML)
+
+    def start_chapter(self, title):
+        """Закрываем текущую главу и начинаем новую
+        """
+        self.end_chapter()
+        name = f'chapter_{len(self.chapters) + 1}.xhtml'
+        self.chapters.append((name, title))
+        self.stream = self.archive.open(f'OEBPS/{name}', 'w')
+        self.stream.write(CHAPTER_HEAD.format(title=escape(title)).encode('utf-8'))
+
+    def write(self, fragment):
+        """Дописываем XHTML фрагмент в текущую главу. Если глав еще не было, начинается глава "Начало"
+        """
+        if self.stream is None:
+            self.start_chapter('Начало')
+        self.stream.write(fragment.encode('utf-8'))
+
+    def end_chapter(self):
+        if self.stream is not None:
+            self.stream.write(CHAPTER_TAIL.encode('utf-8'))
+            self.stream.close()
+            self.stream = None
+
+    def close(self):
+        """Дописываем манифест, порядок чтения и оглавление и закрываем архив
+        """
+        self.end_chapter()
+        if not self.chapters:
+            self.start_chapter('Начало')
+            self.end_chapter()
+        manifest = '\n'.join(
+            f'    <item id="chapter_{i}" href="{name}" media-type="application/xhtml+xml"/>'
+            for i, (name, _) in enumerate(self.chapters, 1))
+        spine = '\n'.join(f'    <itemref idref="chapter_{i}"/>' for i in range(1, len(self.chapters) + 1))
+        self.archive.writestr('OEBPS/content.opf', f'''<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="book_id" version="2.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+    <dc:title>{escape(self.title)}</dc:title>
+    <dc:creator opf:role="aut">{escape(self.author)}</dc:creator>
+    <dc:publisher>{escape(self.author)}</dc:publisher>
+    <dc:language>{escape(self.language)}</dc:language>
+    <dc:identifier id="book_id">{escape(self.identifier)}</dc:identifier>
+  </metadata>
+  <manifest>
+    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+{manifest}
+  </manifest>
+  <spine toc="ncx">
+{spine}
+  </spine>
+</package>
+''')
+        points = '\n'.join(f'''    <navPoint id="chapter_{i}" playOrder="{i}">
+      <navLabel><text>{escape(title)}</text></navLabel>
+      <content src="{name}"/>
+    </navPoint>''' for i, (name, title) in enumerate(self.chapters, 1))
+        self.archive.writestr('OEBPS/toc.ncx', f'''<?xml version="1.0" encoding="UTF-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <head><meta name="dtb:uid" content="{escape(self.identifier)}"/></head>
+  <docTitle><text>{escape(self.title)}</text></docTitle>
+  <navMap>
+{points}
+  </navMap>
+</ncx>
+''')
+        self.archive.close()
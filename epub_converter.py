@@ -1,94 +1,122 @@
-import requests
-from bs4 import BeautifulSoup
-import html2epub
+from lxml import etree
 import os
-import shutil
-import re
+from book_page import BookPage, download_read_page
+from epub_builder import EpubBuilder
 from flibusta_logger import logger
+from conversion_pool import conversion_pool
+
+# меняется при любом изменении результата конвертации, старые файлы в кеше книг перестают находиться
+CONVERTER_VERSION = '2'
+IMAGE_STUB = 'тут в книге должна быть картинка, но по техническим причинам ее нет'
 
-path_to_epub = '/place/here/absolute/path/'
 
 class EpubConverter:
     """Класс конвертера книг из html по ссылке в EPUB.
-    Получает ссылку на книгу и короткое имя для сохранения файла.
+    Страница книги разбирается потоково, главы по мере разбора пишутся прямо в архив EPUB.
     """
 
     def __init__(self, book_link=None, short_book_name=None) -> None:
         pass
 
-    def get_book_data(self):
-        """Получаем имя книги, автора и главы для корректного сохранения файла epub
+    @staticmethod
+    def to_xhtml(element):
+        """Фрагмент книги в XHTML. Изображения заменяются на заглушку, картинки со страницы не скачиваются
+        """
+        for image in list(element.iter('img')):
+            stub = etree.Element('span')
+            stub.text = IMAGE_STUB
+            stub.tail = image.tail
+            image.getparent().replace(image, stub)
+        return etree.tostring(element, method='xml', encoding='unicode', with_tail=False)
+
+    def write_chapters(self, page, builder):
+        """Пишем книгу в EPUB, каждый заголовок h3 начинает новую главу.
+        Первый элемент .book - название книги, он пропускается
 
         Returns:
-            str, str, list: имя автора, название книги, список глав
+            int: сколько фрагментов книги записано
         """
-        try:
-            self.response = requests.get(self.book_read_link)
-        except Exception as error:
-            logger.warning(
-                f'Не получилось достучаться до страницы книги: {self.short_book_name}\n{self.book_read_link}.\n{self.response.status_code}\nОшибка: {error}')
-        self.soup = BeautifulSoup(self.response.text, 'lxml')
-        try:
-            links = self.soup.find_all('a')
-            chapters = []
-            for link in links:
-                if re.search(r'/a/\d+', str(link)):
-                    book_author = link.text
-                elif re.search(r'/b/\d+\"', str(link)):
-                    book_name = link.text
-            headers = self.soup.find_all('h3')
-            for header in headers[1:-1]:
-                chapters.append(header.text)
-            return book_author, book_name, chapters
-        except Exception as error:
-            logger.warning(
-                f'Не удалось получить данные о книге {self.book_read_link}. Ошибка: {error}')
+        fragments = iter(page)
+        next(fragments, None)
+        written = 0
+        for fragment in fragments:
+            if fragment.tag == 'h3':
+                builder.start_chapter(fragment.xpath('string()').strip() or f'Глава {len(builder.chapters) + 1}')
+            builder.write(self.to_xhtml(fragment))
+            written += 1
+        return written
 
-    def get_html_chapters(self):
-        """Сохранение каждой главы в отдельный html файл. Изображения заменяются на заглушку, потому что библиотека конвертации не корректно обрабатывает ссылки и выдает ошибку. Так же добавляется в каждый файл кодировка для правильного отображения кирилицы. 
-        """
-        book = self.soup.find_all(class_='book')
-        if not os.path.exists(f'./files/{self.short_book_name}'):
-            os.mkdir(f'./files/{self.short_book_name}')
-        i = 0
-        for b in book[1:]:
-            if '<h3 class="book">' in str(b):
-                i += 1
-                with open(f'./files/{self.short_book_name}/{i}.html', 'a') as file:
-                    file.write(f'<head><meta charset="UTF-8"></head>\n')
-            text = re.sub(
-                r'<img.+/>', '\n"тут в книге должна быть картинка, но по техническим причинам ее нет"\n', str(b))
-            with open(f'./files/{self.short_book_name}/{i}.html', 'a') as file:
-                file.write(text)
-
-    def make_epub(self, short_book_name, book_link):
-        # в файле usr/local/lib/python3.9/site-packages/html2epub/epub_templates/toc.html заменить <title>目录</title> и  <h2>目录</h2> на "Содержание"
-        """Изготавливаем epub из html файлов по главам. После конвертации удаляем папку с html
+    def convert(self, page_path, encoding, short_book_name, book_read_link):
+        """Изготавливаем epub за один проход по странице, без промежуточных файлов.
+        Выполняется в процессе конвертации, см. convert_epub
+
+        Args:
+            page_path (str): скачанная страница книги /read
+            encoding (str): кодировка страницы или None
+            short_book_name (str): короткое имя книги для файла
+            book_read_link (str): ссылка на страницу книги, для логов
 
         Returns:
-            str: возвращаем короткое имя книги для идентификации файла epub
+            str: возвращаем короткое имя книги для идентификации файла epub или None, если текста книги на странице нет
         """
         self.short_book_name = short_book_name
-        self.book_read_link = f'{book_link}/read'
-        book_author, book_name, chapters = self.get_book_data()
-        self.get_html_chapters()
-        epub = html2epub.Epub(
-            title=book_name, creator=book_author, publisher=book_author)
-        if chapters == []:
-            chapter = html2epub.create_chapter_from_file(
-                f'./files/{self.short_book_name}/0.html', title=f'Начало')
-            epub.add_chapter(chapter)
-        else:
-            for i in range(0, len(chapters)):
-                chapter = html2epub.create_chapter_from_file(
-                    f'./files/{self.short_book_name}/{i+1}.html', title=f'{chapters[i]}')
-                epub.add_chapter(chapter)
+        self.book_read_link = book_read_link
+        path = f'./files/{short_book_name}.epub'
         try:
-            epub.create_epub(
-                output_directory=path_to_epub, epub_name=self.short_book_name) #абсолютный путь до папки files внутри папки с ботом
+            page = BookPage(page_path, encoding)
+            builder = EpubBuilder(f'{path}.part', title=short_book_name, author='Неизвестный автор',
+                                  identifier=book_read_link)
+            try:
+                written = self.write_chapters(page, builder)
+            finally:
+                # автор и название известны только после разбора всей страницы, а пишутся в архив при закрытии
+                builder.title = page.title or builder.title
+                builder.author = page.author or builder.author
+                builder.close()
+            if not written:
+                # пустую книгу не отдаем и не кешируем, пользователь узнает, что книга не доступна
+                logger.warning(f'На странице нет текста книги. {self.book_read_link}')
+                os.remove(f'{path}.part')
+                return None
+            os.replace(f'{path}.part', path)
         except Exception as error:
             logger.warning(
                 f'Не удалось сделать EPUB. {self.book_read_link}\nОшибка: {error}')
-        shutil.rmtree(f'./files/{self.short_book_name}')
+            if os.path.exists(f'{path}.part'):
+                os.remove(f'{path}.part')
+            raise
 
         return self.short_book_name
+
+    async def make_epub(self, short_book_name, book_link):
+        """Скачиваем страницу книги во временный файл и отдаем конвертацию в пул процессов
+
+        Returns:
+            str: возвращаем короткое имя книги для идентификации файла epub или None, если текста книги нет
+        """
+        book_read_link = f'{book_link}/read'
+        try:
+            page_path, encoding = await download_read_page(book_read_link)
+        except Exception as error:
+            logger.warning(
+                f'Не получилось достучаться до страницы книги: {short_book_name}\n{book_read_link}.\nОшибка: {error}')
+            raise
+        try:
+            return await conversion_pool.run(convert_epub, page_path, encoding, short_book_name, book_read_link,
+                                             discard=remove_epub)
+        finally:
+            os.remove(page_path)
+
+
+def remove_epub(short_book_name):
+    """Удаляем EPUB, который рабочий процесс доделал уже после отмены конвертации
+    """
+    path = f'./files/{short_book_name}.epub'
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def convert_epub(page_path, encoding, short_book_name, book_read_link):
+    """Точка входа для процесса конвертации: у каждой конвертации свой экземпляр конвертера
+    """
+    return EpubConverter().convert(page_path, encoding, short_book_name, book_read_link)
@@ -0,0 +1,53 @@
+import sqlite3
+from flibusta_logger import logger
+from sqlite_store import SqliteStore, store_path
+
+
+class FileIdStore(SqliteStore):
+    """Постоянное хранилище file_id Telegram для уже отправленных книг.
+    Книга, отправленная один раз, дальше отправляется по file_id без конвертации и без загрузки файла.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS file_ids (
+            book_id INTEGER, format TEXT, version TEXT, file_id TEXT NOT NULL,
+            PRIMARY KEY (book_id, format, version));'''
+
+    def __init__(self, path='./files/file_ids.sqlite') -> None:
+        super().__init__(path)
+
+    def get(self, book_id, book_format, version):
+        """file_id ранее отправленной книги
+
+        Returns:
+            str: file_id или None
+        """
+        try:
+            row = self.connect().execute(
+                'SELECT file_id FROM file_ids WHERE book_id = ? AND format = ? AND version = ?',
+                (book_id, book_format, str(version))).fetchone()
+        except sqlite3.Error as error:
+            logger.warning(f'Не удалось прочитать file_id книги.\nОшибка: {error}')
+            return None
+        return row[0] if row else None
+
+    def set(self, book_id, book_format, version, file_id):
+        try:
+            with self.connect() as db:
+                db.execute('INSERT OR REPLACE INTO file_ids VALUES (?, ?, ?, ?)',
+                           (book_id, book_format, str(version), file_id))
+        except sqlite3.Error as error:
+            logger.warning(f'Не удалось сохранить file_id книги.\nОшибка: {error}')
+
+    def forget(self, book_id, book_format, version):
+        """Убираем file_id, который Telegram больше не принимает
+        """
+        try:
+            with self.connect() as db:
+                db.execute('DELETE FROM file_ids WHERE book_id = ? AND format = ? AND version = ?',
+                           (book_id, book_format, str(version)))
+        except sqlite3.Error as error:
+            logger.warning(f'Не удалось удалить file_id книги.\nОшибка: {error}')
+
+
+file_id_store = FileIdStore(path=store_path('FLIBUSTA_FILE_ID_DB', './files/file_ids.sqlite'))
@@ -0,0 +1,85 @@
+from array import array
+from math import ceil
+from flibusta_logger import logger
+
+
+def trigrams(word):
+    """Набор триграмм слова. Слово дополняется пробелами с краев, чтобы начало и конец слова
+    весили больше середины: "кинг" -> "  к", " ки", "кин", "инг", "нг "
+
+    Returns:
+        set: триграммы слова
+    """
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """Триграммный индекс по словарю слов каталога для поиска с опечатками.
+    Похожесть двух слов - доля общих триграмм: общие / (все триграммы обоих слов без повторов).
+    Числа (годы, id книг) в индекс не попадают.
+    """
+
+    def __init__(self, tokens, threshold=0.4) -> None:
+        """Строим индекс
+
+        Args:
+            tokens (list): нормализованные слова каталога, см. search_index.tokenize
+            threshold (float): минимальная похожесть, при которой слово считается кандидатом
+        """
+        self.threshold = threshold
+        self.words = []
+        self.postings = {}
+        self.add_tokens(tokens)
+        logger.debug(
+            f'Триграммный индекс построен. Слов: {len(self.words)}, триграмм: {len(self.postings)}')
+
+    def add_tokens(self, tokens):
+        """Добавляем в индекс новые слова, например после накатывания изменений каталога
+        """
+        for token in tokens:
+            if token.isdigit():
+                continue
+            word_id = len(self.words)
+            self.words.append(token)
+            for trigram in trigrams(token):
+                posting = self.postings.get(trigram)
+                if posting is None:
+                    posting = self.postings[trigram] = array('I')
+                posting.append(word_id)
+
+    def similar(self, word, limit=5, threshold=None):
+        """Ищем слова словаря, похожие на word.
+        Чтобы не перебирать длинные списки частых триграмм, кандидаты берутся только из самых редких
+        списков: слово с похожестью не ниже порога обязано встретиться хотя бы в одном из них.
+        Кандидаты проверяются точным подсчетом похожести.
+
+        Args:
+            word (str): нормализованное слово запроса
+            limit (int): сколько кандидатов вернуть
+            threshold (float, optional): порог похожести, по умолчанию порог индекса
+
+        Returns:
+            list: пары (слово, похожесть) от самого похожего
+        """
+        threshold = self.threshold if threshold is None else threshold
+        query = trigrams(word)
+        # для похожести t нужно не меньше t * |query| общих триграмм
+        needed = max(1, ceil(threshold * len(query)))
+        lists = sorted((self.postings.get(trigram, ()) for trigram in query), key=len)
+        candidates = set()
+        for posting in lists[:len(query) - needed + 1]:
+            candidates.update(posting)
+        min_size, max_size = threshold * len(query), len(query) / threshold
+        found = []
+        for word_id in candidates:
+            other = trigrams(self.words[word_id])
+            if not min_size <= len(other) <= max_size:
+                continue
+            common = len(query & other)
+            similarity = common / (len(query) + len(other) - common)
+            if similarity >= threshold:
+                found.append((similarity, self.words[word_id]))
+        found.sort(key=lambda pair: (-pair[0], pair[1]))
+
+        return [(token, similarity) for similarity, token in found[:limit]]
@@ -0,0 +1,107 @@
+import aiohttp
+import asyncio
+from contextlib import asynccontextmanager
+from flibusta_logger import logger
+
+
+# статусы, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HttpClient:
+    """Общий HTTP клиент бота для всех запросов к flibusta.site.
+    Держит одну долгоживущую сессию с пулом keep-alive соединений, ограничивает число соединений
+    на хост и общее число одновременных запросов, повторяет неудачные запросы с нарастающей паузой.
+    """
+
+    def __init__(self, limit=32, limit_per_host=8, concurrency=16, timeout=60, retries=3, backoff=1.0) -> None:
+        """
+        Args:
+            limit (int): всего соединений в пуле
+            limit_per_host (int): соединений к одному хосту
+            concurrency (int): одновременных запросов на весь бот
+            timeout (int): таймаут запроса по умолчанию в секундах
+            retries (int): сколько раз повторять неудачный запрос
+            backoff (float): пауза перед первым повтором, дальше удваивается
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=15)
+        self.retries = retries
+        self.backoff = backoff
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.session = None
+
+    async def get_session(self):
+        """Сессия создается при первом запросе, когда уже запущен цикл событий
+        """
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit, limit_per_host=self.limit_per_host, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def send(self, url, headers=None, timeout=None):
+        """GET запрос с повторами. Повторяются сетевые ошибки, таймауты и статусы из RETRY_STATUSES
+
+        Returns:
+            aiohttp.ClientResponse: ответ с непрочитанным телом, его надо освободить
+        """
+        session = await self.get_session()
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                response = await session.get(url, headers=headers, timeout=timeout or self.timeout)
+                if response.status not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                response.release()
+                logger.info(f'Сервер ответил {response.status}, повторяем запрос: {url}')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                if attempt == self.retries:
+                    raise
+                logger.info(f'Запрос не удался, повторяем: {url}\nОшибка: {error}')
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    @asynccontextmanager
+    async def stream(self, url, headers=None, timeout=None):
+        """Ответ для потокового чтения тела. Пока ответ открыт, он занимает место в общем лимите запросов
+
+        Args:
+            url (str): адрес
+            headers (dict, optional): дополнительные заголовки
+            timeout (aiohttp.ClientTimeout, optional): таймаут вместо общего, например для больших файлов
+        """
+        async with self.semaphore:
+            response = await self.send(url, headers=headers, timeout=timeout)
+            try:
+                yield response
+            finally:
+                response.release()
+
+    async def get_text(self, url):
+        """Текст страницы
+
+        Returns:
+            str: тело ответа
+        """
+        async with self.stream(url) as response:
+            response.raise_for_status()
+            return await response.text()
+
+    async def get_bytes(self, url):
+        """Тело ответа как есть, например для RSS
+
+        Returns:
+            bytes: тело ответа
+        """
+        async with self.stream(url) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+http_client = HttpClient()
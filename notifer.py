@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 import feedparser
+import asyncio
 from flibusta_logger import logger
 import os
 import json
 from catalog import Catalog
+from http_client import http_client
+from subscription_store import subscription_store
 
 
 catalog = Catalog()
+# сколько аннотаций новых книг качаем одновременно
+SUMMARY_CONCURRENCY = 8
 
 
 class Notifer:
@@ -20,29 +25,56 @@ class Notifer:
         self.notify_time = notify_time
 
     async def get_new_books_list(self):
-        """Получаем данные о новых книжках на сайте через RSS
+        """Получаем данные о новых книжках на сайте через RSS.
+        Лента скачивается асинхронно и разбирается в отдельном потоке, аннотации качаются параллельно,
+        но не больше SUMMARY_CONCURRENCY одновременно. Аннотации книг, которые были в ленте
+        в прошлый раз, берутся из new_books.json без запросов к сайту.
 
         Returns:
             list: получаем список новых книг с описанием и ссылкой.
         """
         new_books_list = []
-        data = feedparser.parse(self.feed_url)
+        try:
+            body = await http_client.get_bytes(self.feed_url)
+            data = await asyncio.to_thread(feedparser.parse, body)
+        except Exception as error:
+            logger.warning(f'Не удалось получить RSS с новыми книгами.\nОшибка: {error}')
+            return new_books_list
         books = data['entries']
-        for book in books:
-            book_name = book['title_detail']['value'].strip()
-            book_link = book['link'].strip()
-            # берем не из rss чтобы было точнее.
-            book_summary = await catalog.get_book_summary(book_url=book_link)
+        known_summaries = self.load_known_summaries()
+        semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+
+        async def get_summary(book_link):
+            if known_summaries.get(book_link):
+                return known_summaries[book_link]
+            async with semaphore:
+                # берем не из rss чтобы было точнее.
+                return await catalog.get_book_summary(book_url=book_link)
+
+        links = [book['link'].strip() for book in books]
+        summaries = await asyncio.gather(*(get_summary(link) for link in links))
+        for book, book_link, book_summary in zip(books, links, summaries):
             new_books_list.append({
-                'book_name': book_name,
+                'book_name': book['title_detail']['value'].strip(),
                 'book_summary': book_summary.strip(),
                 'book_link': book_link
             })
         logger.debug(
-            f'Список новых книг получен. Новых книг - {len(new_books_list)}')
+            f'Список новых книг получен. Новых книг - {len(new_books_list)}, аннотаций из прошлого списка - {len(set(links) & known_summaries.keys())}')
 
         return new_books_list
 
+    def load_known_summaries(self):
+        """Аннотации книг из прошлого списка новых книг
+
+        Returns:
+            dict: ссылка на книгу -> аннотация
+        """
+        try:
+            return {book['book_link']: book['book_summary'] for book in self.load_books_list_from_json()}
+        except Exception:
+            return {}
+
     async def write_new_books_to_json(self):
         """Записываем полученые по RSS книги в файл.
         Если файл не существует записываем полностью.
@@ -98,52 +130,13 @@ class Notifer:
         return lists_dif
 
     def set_user_schedule(self, user_id, notify_time):
-        """Если файла с расписанием нет - создаем
-        Если пользователь уже создавал расписание - изменяем время
-        Если пользователь установил время впервые, добавляем в json
+        """Подписываем пользователя на время, меняем время или отписываем, если notify_time 'None'
 
         Args:
             user_id (str): идентификатор пользователя
             notify_time (str): время когда надо присылать новости
         """
-        user_timer = {'user_id': user_id,
-                      'notify_time': notify_time}
-        data = []
-        if not os.path.exists('./files/schedule.json'):
-            with open('./files/schedule.json', 'w') as file:
-                data.append(user_timer)
-                json.dump(data, file, ensure_ascii=False, indent=4)
-        else:
-            with open('./files/schedule.json', 'r') as file:
-                data = json.load(file)
-            is_found = False
-            for d in data:
-                if user_id in d['user_id']:
-                    d['notify_time'] = notify_time
-                    is_found = True
-                    break
-            if is_found == False:
-                data.append(user_timer)
-            with open('./files/schedule.json', 'w') as file:
-                json.dump(data, file, ensure_ascii=False, indent=4)
-
-    async def get_user_id_to_send(self, notify_time):
-        """получаем список пользователей которым надо отправить уведомление о новых книжках
-
-        Args:
-            notify_time (str): время уведомления
-
-        Returns:
-            list: список пользователей для отправки уведомлений
-        """
-        user_id_to_send = []
-        with open('./files/schedule.json') as file:
-            user_schedule = json.load(file)
-        for i in user_schedule:
-            if i['notify_time'] == notify_time:
-                user_id_to_send.append(int(i['user_id']))
-
-        return user_id_to_send
+        subscription_store.set(user_id, notify_time)
 
     async def get_dif_books(self):
         """Получаем новые книжки из файла
@@ -1,9 +1,58 @@
 import weasyprint
-import requests
-from bs4 import BeautifulSoup
+from weasyprint.text.fonts import FontConfiguration
+from html import escape
+from lxml import etree
+from pypdf import PdfWriter
 import os
+import resource
+from book_page import BookPage, download_read_page
 from flibusta_logger import logger
-import shutil
+from conversion_pool import conversion_pool
+
+# меняется при любом изменении результата конвертации, старые файлы в кеше книг перестают находиться
+CONVERTER_VERSION = '2'
+# книга рендерится кусками примерно такого размера HTML, куски по возможности режутся по главам
+CHUNK_CHARS = 256 * 1024
+MAX_PAGES = int(os.getenv('FLIBUSTA_PDF_MAX_PAGES', '2000'))
+MAX_MEMORY = int(os.getenv('FLIBUSTA_PDF_MAX_MB', '1024')) * 1024 ** 2
+BOOK_CSS = '''
+@page { size: A5; margin: 15mm 12mm; }
+body { font-family: serif; font-size: 11pt; line-height: 1.35; }
+h3 { break-before: page; }
+img { display: none; }
+'''
+
+# настройки шрифтов и стили собираются один раз на рабочий процесс и переиспользуются всеми конвертациями
+pdf_setup = None
+
+
+class BookTooLarge(Exception):
+    """Книга не укладывается в ограничения на число страниц или память для PDF"""
+
+
+def get_pdf_setup():
+    global pdf_setup
+    if pdf_setup is None:
+        font_config = FontConfiguration()
+        pdf_setup = font_config, weasyprint.CSS(string=BOOK_CSS, font_config=font_config)
+    return pdf_setup
+
+
+def no_fetch(url):
+    """Картинки и внешние ресурсы со страницы не скачиваются, чтобы рендер не ждал сеть
+    """
+    raise ValueError(f'Внешние ресурсы не загружаются: {url}')
+
+
+def memory_used():
+    """Текущий объем памяти процесса в байтах (на Linux), иначе пиковый.
+    Процесс конвертации живет долго, поэтому ограничение сравнивается с приростом за конвертацию
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
 
 
 class PdfConverter:
@@ -14,38 +63,137 @@ class PdfConverter:
     def __init__(self, book_link=None, book_name=None) -> None:
         pass
 
-    def make_pdf(self, book_name, book_link):
-        """Делаем pdf из HTML. Сохраням HTML в папку, удаляем лишние данные, добавляем кодировку для отображения кирилицы. После конвертации удаляем папку с HTML
+    def get_chunks(self, page_path, encoding):
+        """Собираем фрагменты книги в куски HTML для рендера. Новый кусок начинается с главы,
+        когда текущий набрал CHUNK_CHARS, или с любого фрагмента, если глав давно не было
+
+        Yields:
+            str: HTML куска
+        """
+        head = f'<html><head><meta charset="UTF-8"><title>{escape(self.book_name)}</title></head><body>'
+        parts, size = [], 0
+        for fragment in BookPage(page_path, encoding):
+            if parts and (size >= 2 * CHUNK_CHARS or size >= CHUNK_CHARS and fragment.tag == 'h3'):
+                yield head + ''.join(parts) + '</body></html>'
+                parts, size = [], 0
+            text = etree.tostring(fragment, method='html', encoding='unicode', with_tail=False)
+            parts.append(text)
+            size += len(text)
+        if parts:
+            yield head + ''.join(parts) + '</body></html>'
+
+    def render(self, page_path, encoding, target):
+        """Рендерим книгу по кускам с общими стилями и шрифтами, каждый кусок сразу пишется в свой PDF,
+        так что в памяти всегда только разметка одного куска. Следим за числом страниц и памятью
+
+        Args:
+            target (str): путь, от которого строятся имена PDF кусков
+
+        Raises:
+            BookTooLarge: если книга выходит за MAX_PAGES или MAX_MEMORY
+
+        Yields:
+            str: путь до PDF очередного куска
+        """
+        font_config, css = get_pdf_setup()
+        start_memory = memory_used()
+        pages = 0
+        for number, chunk in enumerate(self.get_chunks(page_path, encoding)):
+            document = weasyprint.HTML(string=chunk, url_fetcher=no_fetch).render(
+                stylesheets=[css], font_config=font_config)
+            pages += len(document.pages)
+            if pages > MAX_PAGES:
+                raise BookTooLarge(f'больше {MAX_PAGES} страниц')
+            part = f'{target}.{number}'
+            document.write_pdf(part)
+            del document
+            yield part
+            if memory_used() - start_memory > MAX_MEMORY:
+                raise BookTooLarge(f'больше {MAX_MEMORY // 1024 ** 2} МБ памяти на {pages} страницах')
+
+    def merge(self, parts, target):
+        """Склеиваем PDF кусков в один файл
+        """
+        if len(parts) == 1:
+            os.replace(parts[0], target)
+            return
+        writer = PdfWriter()
+        for part in parts:
+            writer.append(part)
+        writer.add_metadata({'/Title': self.book_name})
+        with open(target, 'wb') as file:
+            writer.write(file)
+
+    def convert(self, page_path, encoding, book_name, book_read_link):
+        """Делаем pdf из страницы книги. Книга рендерится кусками, PDF кусков склеиваются в один.
+        Выполняется в процессе конвертации, см. convert_pdf
+
+        Args:
+            page_path (str): скачанная страница книги /read
+            encoding (str): кодировка страницы или None
+            book_name (str): короткое имя книги для файла
+            book_read_link (str): ссылка на страницу книги, для логов
+
+        Raises:
+            BookTooLarge: если книга слишком большая для PDF
 
         Returns:
             str: возвращаем короткое имя книги для идентифицаии файла
         """
-        self.book_read_link = f'{book_link}/read'
+        self.book_read_link = book_read_link
         self.book_name = book_name
+        path = f'./files/{book_name}.pdf'
+        parts = []
         try:
-            response = requests.get(self.book_read_link)
+            for part in self.render(page_path, encoding, f'{path}.part'):
+                parts.append(part)
+            if not parts:
+                return None
+            self.merge(parts, f'{path}.part')
+            os.replace(f'{path}.part', path)
+        except BookTooLarge as error:
+            logger.info(f'Книга слишком большая для PDF: {self.book_read_link}, {error}')
+            raise
         except Exception as error:
             logger.warning(
-                f'Не получилось достучаться до страницы книги: {book_name}\n{book_link}.\n{self.response.status_code}\nОшибка: {error}')
-        soup = BeautifulSoup(response.text, 'lxml')
-        book = soup.find_all(class_='book')
-        if book != []:
-            if not os.path.exists(f'./files/{self.book_name}'):
-                os.mkdir(f'./files/{self.book_name}')
-            with open(f'./files/{self.book_name}/{self.book_name}.html', 'a') as file:
-                file.write(
-                    f'<head><meta charset="UTF-8">\n<title>{self.book_name}</title></head>')
-            for i in book:
-                with open(f'./files/{self.book_name}/{self.book_name}.html', 'a') as file:
-                    file.write(str(i))
-            try:
-                weasyprint.HTML(
-                    filename=f'./files/{self.book_name}/{self.book_name}.html').write_pdf(f'./files/{self.book_name}.pdf')
-            except Exception as error:
-                logger.warning(
-                    f'Не удалось сделать PDF.\nКнига: {self.book_read_link}\nОшибка: {error}')
-            shutil.rmtree(f'./files/{self.book_name}')
-        else:
-            self.book_name = None
+                f'Не удалось сделать PDF.\nКнига: {self.book_read_link}\nОшибка: {error}')
+            raise
+        finally:
+            for leftover in parts + [f'{path}.part']:
+                if os.path.exists(leftover):
+                    os.remove(leftover)
 
         return self.book_name
+
+    async def make_pdf(self, book_name, book_link):
+        """Скачиваем страницу книги во временный файл и отдаем конвертацию в пул процессов
+
+        Returns:
+            str: возвращаем короткое имя книги для идентифицаии файла
+        """
+        book_read_link = f'{book_link}/read'
+        try:
+            page_path, encoding = await download_read_page(book_read_link)
+        except Exception as error:
+            logger.warning(
+                f'Не получилось достучаться до страницы книги: {book_name}\n{book_link}.\nОшибка: {error}')
+            raise
+        try:
+            return await conversion_pool.run(convert_pdf, page_path, encoding, book_name, book_read_link,
+                                             discard=remove_pdf)
+        finally:
+            os.remove(page_path)
+
+
+def remove_pdf(book_name):
+    """Удаляем PDF, который рабочий процесс доделал уже после отмены конвертации
+    """
+    path = f'./files/{book_name}.pdf'
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def convert_pdf(page_path, encoding, book_name, book_read_link):
+    """Точка входа для процесса конвертации: у каждой конвертации свой экземпляр конвертера
+    """
+    return PdfConverter().convert(page_path, encoding, book_name, book_read_link)
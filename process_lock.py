@@ -0,0 +1,48 @@
+import asyncio
+import fcntl
+import os
+
+
+class FileLock:
+    """Блокировка между процессами бота на fcntl.flock.
+    Ядро снимает блокировку, когда процесс завершается, даже аварийно, поэтому зависших блокировок не бывает.
+    Один и тот же файл блокируется и между разными FileLock внутри одного процесса.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.file = None
+
+    @property
+    def held(self):
+        return self.file is not None
+
+    def acquire(self):
+        """Пробуем взять блокировку, не дожидаясь
+
+        Returns:
+            bool: взята ли блокировка этим объектом
+        """
+        if self.file is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        file = open(self.path, 'a')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return False
+        self.file = file
+        return True
+
+    async def wait(self, poll=0.5):
+        """Ждем блокировку, не занимая поток: flock без LOCK_NB остановил бы весь цикл событий
+        """
+        while not self.acquire():
+            await asyncio.sleep(poll)
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
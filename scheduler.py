@@ -0,0 +1,170 @@
+import asyncio
+import datetime
+import os
+import sqlite3
+import time
+from zoneinfo import ZoneInfo
+from flibusta_logger import logger
+from sqlite_store import SqliteStore, store_path
+
+
+# дольше не спим, даже если до задачи далеко: после перевода системных часов
+# или сна машины расписание пересчитается не позже чем через час
+MAX_SLEEP = 3600
+
+
+class Job:
+    """Задача планировщика: корутинная функция, которая запускается ежедневно в заданное время
+    или сразу после успешного завершения другой задачи
+    """
+
+    def __init__(self, name, func, at=(), after=None, args=(), kwargs=None) -> None:
+        self.name = name
+        self.func = func
+        self.at = [datetime.time.fromisoformat(moment) for moment in at]
+        self.after = after
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.next_run = None
+        self.running = False
+
+    def next_after(self, moment, timezone):
+        """Ближайшее время запуска строго после moment
+
+        Args:
+            moment (datetime.datetime): время с часовым поясом
+            timezone (ZoneInfo): часовой пояс, в котором заданы времена задачи
+
+        Returns:
+            datetime.datetime: время запуска или None, если задача запускается только после другой
+        """
+        local = moment.astimezone(timezone)
+        candidates = []
+        for day in (local.date(), local.date() + datetime.timedelta(days=1)):
+            for at in self.at:
+                candidate = datetime.datetime.combine(day, at, tzinfo=timezone)
+                if candidate > local:
+                    candidates.append(candidate)
+        return min(candidates, default=None)
+
+
+class Scheduler(SqliteStore):
+    """Ежедневные задачи бота по времени в одном часовом поясе.
+    Планировщик спит до ближайшей задачи, а не просыпается каждую секунду. Задача, запущенная раньше
+    и еще не завершенная, второй раз не запускается. Задачи с after запускаются только после успешного
+    завершения той задачи, от которой зависят; если она вернула False, делать дальше нечего
+    и зависимые задачи не запускаются. Длительность и итог каждого запуска пишутся в лог и в sqlite.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS job_runs (
+            name TEXT NOT NULL, started REAL NOT NULL, duration REAL NOT NULL,
+            outcome TEXT NOT NULL, error TEXT);
+        CREATE INDEX IF NOT EXISTS job_runs_name ON job_runs (name, started);'''
+
+    def __init__(self, path='./files/scheduler.sqlite', timezone='Europe/Moscow') -> None:
+        """
+        Args:
+            path (str, optional): файл sqlite с историей запусков, None - история в памяти процесса
+            timezone (str): часовой пояс, в котором заданы времена задач
+        """
+        super().__init__(path)
+        self.timezone = ZoneInfo(timezone)
+        self.jobs = {}
+        self.tasks = set()
+
+
+    def add(self, name, func, at=(), after=None, args=(), kwargs=None):
+        """Добавляем задачу
+
+        Args:
+            name (str): уникальное имя задачи
+            func: корутинная функция
+            at (list): времена запуска 'ЧЧ:ММ' в часовом поясе планировщика
+            after (str, optional): имя задачи, после успешного завершения которой запускается эта
+            args, kwargs: аргументы func
+        """
+        if after is not None and after not in self.jobs:
+            raise ValueError(f'Задача {name} зависит от неизвестной задачи {after}')
+        self.jobs[name] = Job(name, func, at, after, args, kwargs)
+
+    def now(self):
+        return datetime.datetime.now(self.timezone)
+
+    async def run(self):
+        """Бесконечный цикл планировщика
+        """
+        now = self.now()
+        for job in self.jobs.values():
+            job.next_run = job.next_after(now, self.timezone)
+        while True:
+            planned = [job for job in self.jobs.values() if job.next_run is not None]
+            if not planned:
+                return
+            now = self.now()
+            for job in planned:
+                if job.next_run <= now:
+                    # следующий запуск считаем от запланированного, а не от текущего времени,
+                    # чтобы проснувшись с опозданием не пропустить ничего
+                    job.next_run = job.next_after(job.next_run, self.timezone)
+                    self.start(job)
+            wake = min(job.next_run for job in planned)
+            await asyncio.sleep(min(max((wake - self.now()).total_seconds(), 0), MAX_SLEEP))
+
+    def start(self, job):
+        task = asyncio.create_task(self.execute(job))
+        # держим ссылку, иначе задача может быть собрана сборщиком мусора до завершения
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def execute(self, job):
+        """Запуск задачи с защитой от повторного запуска и записью итога
+
+        Returns:
+            str: итог 'ok', 'unchanged', 'failed' или 'skipped'
+        """
+        if job.running:
+            logger.warning(f'Задача {job.name} еще выполняется с прошлого запуска, запуск пропущен')
+            self.record(job.name, time.time(), 0, 'skipped')
+            return 'skipped'
+        job.running = True
+        started, clock = time.time(), time.monotonic()
+        error = None
+        try:
+            result = await job.func(*job.args, **job.kwargs)
+            outcome = 'unchanged' if result is False else 'ok'
+        except Exception as exc:
+            outcome, error = 'failed', repr(exc)
+            logger.exception(f'Задача {job.name} завершилась с ошибкой')
+        finally:
+            job.running = False
+        duration = time.monotonic() - clock
+        logger.info(f'Задача {job.name}: {outcome} за {duration:.1f} секунд')
+        self.record(job.name, started, duration, outcome, error)
+        if outcome == 'ok':
+            for dependent in self.jobs.values():
+                if dependent.after == job.name:
+                    self.start(dependent)
+        return outcome
+
+    def record(self, name, started, duration, outcome, error=None):
+        try:
+            db = self.connect()
+            with db:
+                db.execute('INSERT INTO job_runs VALUES (?, ?, ?, ?, ?)', (name, started, duration, outcome, error))
+        except sqlite3.Error as exc:
+            logger.warning(f'Не удалось сохранить итог задачи {name}.\nОшибка: {exc}')
+
+    def last_runs(self):
+        """Последний запуск каждой задачи
+
+        Returns:
+            list: (имя, время начала, длительность, итог, ошибка)
+        """
+        return self.connect().execute(
+            '''SELECT name, MAX(started), duration, outcome, error FROM job_runs
+            GROUP BY name ORDER BY name''').fetchall()
+
+
+scheduler = Scheduler(path=store_path('FLIBUSTA_SCHEDULER_DB', './files/scheduler.sqlite'),
+                      timezone=os.getenv('FLIBUSTA_TIMEZONE', 'Europe/Moscow'))
@@ -0,0 +1,270 @@
+import re
+import heapq
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from flibusta_logger import logger
+
+
+TOKEN_RE = re.compile(r'\w+')
+# вес совпадения слова запроса по полям: автор, название, серия. Остальные поля (язык, год, id) дают 0
+FIELD_WEIGHTS = (6, 4, 2)
+# бонус за полное совпадение слова, а не только начала. Меньше разницы весов соседних полей,
+# чтобы точное совпадение в названии не догоняло совпадение началом слова в авторе
+EXACT_BONUS = 1
+# сколько кандидатов ранжированный поиск готов проверить по слишком общему запросу,
+# лучшие строки выбираются только среди них
+SCAN_LIMIT = 3000
+# то же для подсказок по мере набора, им важнее скорость ответа, чем полнота
+PREFIX_SCAN_LIMIT = 500
+
+
+def tokenize(text):
+    """Разбиваем строку на нормализованные слова: нижний регистр, ё заменяется на е
+
+    Args:
+        text (str): строка каталога или запрос пользователя
+
+    Returns:
+        list: список слов в нижнем регистре
+    """
+    return TOKEN_RE.findall(text.lower().replace('ё', 'е'))
+
+
+class SearchIndex:
+    """Инвертированный индекс по каталогу: слово -> список номеров строк.
+    Строится один раз из catalog.txt и пересобирается при обновлении каталога.
+
+    Отличия от старого поиска подстрокой по всей строке:
+    - слово запроса ищется как начало слова в каталоге ("поттер" найдет "Поттера",
+      но "оттер" не найдет "Поттер");
+    - слово запроса с разделителями ("т.е.") разбивается на части, каждая часть
+      ищется отдельно и без учета порядка;
+    - ё и е не различаются;
+    - пустой запрос ничего не находит, а не возвращает весь каталог;
+    - результаты ранжируются по тому, в каком поле нашлись слова, см. ranked_search.
+    """
+
+    def __init__(self, store) -> None:
+        """Строим индекс
+
+        Args:
+            store (CatalogStore): разобранный каталог, номера строк индекса - его row id
+        """
+        self.store = store
+        postings = {}
+        for row_id in range(len(store)):
+            for token in set(tokenize(store.row_text(row_id))):
+                posting = postings.get(token)
+                if posting is None:
+                    posting = postings[token] = array('I')
+                posting.append(row_id)
+        self.tokens = sorted(postings)
+        self.postings = [postings[token] for token in self.tokens]
+        self.update_sizes()
+        logger.debug(
+            f'Индекс построен. Строк: {len(store)}, слов: {len(self.tokens)}')
+
+    def update_sizes(self):
+        """Пересчитываем накопленные размеры списков. Отсортированный словарь нужен для поиска
+        по началу слова, накопленные размеры - для оценки длины объединения списков без их сборки
+        """
+        self.cum_sizes = array('Q', accumulate(map(len, self.postings), initial=0))
+
+    def add_rows(self, row_ids):
+        """Дописываем в индекс новые строки хранилища после накатывания изменений каталога.
+        Новые row id всегда больше старых, поэтому списки остаются отсортированными.
+        Удаленные строки из списков не вычищаются, поиск отбрасывает их по store.alive.
+
+        Args:
+            row_ids (list): row id добавленных строк по возрастанию
+
+        Returns:
+            list: слова, которых раньше не было в словаре
+        """
+        new_postings = {}
+        for row_id in row_ids:
+            for token in set(tokenize(self.store.row_text(row_id))):
+                start, end = self.token_range(token)
+                if start < end and self.tokens[start] == token:
+                    self.postings[start].append(row_id)
+                else:
+                    new_postings.setdefault(token, array('I')).append(row_id)
+        if new_postings:
+            # новых слов немного: вклеиваем их кусками между срезами старого словаря
+            tokens, postings = [], []
+            previous = 0
+            for token in sorted(new_postings):
+                position = bisect_left(self.tokens, token, lo=previous)
+                tokens.extend(self.tokens[previous:position])
+                postings.extend(self.postings[previous:position])
+                tokens.append(token)
+                postings.append(new_postings[token])
+                previous = position
+            tokens.extend(self.tokens[previous:])
+            postings.extend(self.postings[previous:])
+            self.tokens, self.postings = tokens, postings
+        self.update_sizes()
+
+        return list(new_postings)
+
+    def token_range(self, prefix):
+        """Диапазон слов словаря, начинающихся с prefix
+
+        Returns:
+            tuple: (начало, конец) в self.tokens
+        """
+        start = bisect_left(self.tokens, prefix)
+        end = bisect_left(self.tokens, prefix + '\uffff', lo=start)
+        return start, end
+
+    def estimate(self, prefix):
+        """Суммарная длина списков строк для всех слов с данным началом
+        """
+        start, end = self.token_range(prefix)
+        return self.cum_sizes[end] - self.cum_sizes[start]
+
+    def score_row(self, row_id, words):
+        """Оценка строки для ранжирования: за каждое слово запроса берется лучший вес поля,
+        в котором оно нашлось, плюс бонус за точное совпадение слова
+
+        Returns:
+            int: оценка строки или -1, если какого-то слова в строке нет
+        """
+        fields = [tokenize(field) for field in self.store.search_fields(row_id)]
+        score = 0
+        for word in words:
+            best = -1
+            for tokens, weight in zip(fields, FIELD_WEIGHTS + (0,)):
+                for token in tokens:
+                    if token.startswith(word):
+                        best = max(best, weight + EXACT_BONUS if token == word else weight)
+            if best < 0:
+                return -1
+            score += best
+        return score
+
+    def ranked_search(self, query, limit=30):
+        """Ранжированный поиск: лучшие limit строк по оценке score_row и примерное число всех совпадений.
+        Кандидаты идут по спискам самого редкого слова в порядке каталога, остальные слова проверяются
+        по самой строке. Перебор останавливается, когда набрано limit строк с максимальной оценкой,
+        или после SCAN_LIMIT кандидатов - тогда общее число совпадений оценивается по доле найденного.
+        Это приближение: у общего запроса, под который подходит больше SCAN_LIMIT строк, лучшие строки
+        выбираются только из первых SCAN_LIMIT совпадений по каталогу, и более подходящая книга дальше
+        по каталогу может не попасть в выдачу. Поле, в котором нашлось слово, индекс не хранит,
+        поэтому пройти сначала совпадения в авторе без проверки каждой строки нельзя.
+
+        Args:
+            query (str): запрос пользователя
+            limit (int): сколько лучших строк вернуть
+
+        Returns:
+            list, int: row id от лучшей к худшей и оценка общего числа совпадений
+        """
+        words = sorted(set(tokenize(query)), key=self.estimate)
+        if not words:
+            return [], 0
+        best_score = (max(FIELD_WEIGHTS) + EXACT_BONUS) * len(words)
+        alive = self.store.alive
+        start, end = self.token_range(words[0])
+        candidates = heapq.merge(*self.postings[start:end])
+        top = []
+        scanned = matched = 0
+        previous = None
+        complete = True
+        for row_id in candidates:
+            if row_id == previous:
+                continue
+            previous = row_id
+            if scanned >= SCAN_LIMIT:
+                complete = False
+                break
+            scanned += 1
+            if not alive[row_id]:
+                continue
+            score = self.score_row(row_id, words)
+            if score < 0:
+                continue
+            matched += 1
+            item = (score, -row_id)
+            if len(top) < limit:
+                heapq.heappush(top, item)
+            elif item > top[0]:
+                heapq.heapreplace(top, item)
+            if len(top) == limit and top[0][0] == best_score:
+                complete = False
+                break
+        if complete:
+            total = matched
+        else:
+            # доля совпадений среди проверенных, перенесенная на весь список самого редкого слова
+            total = max(matched, round(matched / scanned * self.estimate(words[0])))
+
+        return [-row_id for _, row_id in sorted(top, reverse=True)], total
+
+    def prefix_search(self, query, limit=50):
+        """Быстрый поиск для подсказок по мере набора: первые limit строк, где есть все слова запроса.
+        В отличие от ranked_search строки не оцениваются: берутся списки самого редкого слова, сначала
+        точное совпадение, потом остальные слова с этим началом, в каждом списке от новых книг к старым.
+        Остальные слова проверяются по строке, но не больше PREFIX_SCAN_LIMIT кандидатов, поэтому время ответа
+        не зависит от того, насколько общий запрос.
+
+        Args:
+            query (str): набранный текст, последнее слово может быть недописанным
+            limit (int): сколько строк вернуть
+
+        Returns:
+            list: row id в порядке выдачи, порядок одинаковый для одинакового запроса
+        """
+        words = sorted(set(tokenize(query)), key=self.estimate)
+        if not words:
+            return []
+        alive = self.store.alive
+        start, end = self.token_range(words[0])
+        result = []
+        seen = set()
+        scanned = 0
+        for position in range(start, end):
+            for row_id in reversed(self.postings[position]):
+                if row_id in seen or not alive[row_id]:
+                    continue
+                seen.add(row_id)
+                if len(words) > 1:
+                    scanned += 1
+                    if scanned > PREFIX_SCAN_LIMIT:
+                        return result
+                    tokens = tokenize(self.store.row_text(row_id))
+                    if not all(any(token.startswith(word) for token in tokens) for word in words[1:]):
+                        continue
+                result.append(row_id)
+                if len(result) >= limit:
+                    return result
+        return result
+
+    def correct_query(self, query, fuzzy, variants=3):
+        """Варианты исправления запроса с опечатками: каждое слово, которого нет в словаре
+        даже как начало слова, заменяется похожим словом из триграммного индекса
+
+        Args:
+            query (str): запрос пользователя
+            fuzzy (TrigramIndex): триграммный индекс по словарю этого индекса
+            variants (int): сколько вариантов замены пробовать для каждого слова
+
+        Returns:
+            list: исправленные запросы от самого вероятного, пустой если исправлять нечего
+        """
+        words = tokenize(query)
+        corrected = [[word] if self.estimate(word) else
+                     [token for token, _ in fuzzy.similar(word, limit=variants)]
+                     for word in words]
+        if all(len(options) == 1 and options[0] == word for options, word in zip(corrected, words)):
+            return []
+        if any(not options for options in corrected):
+            return []
+        # варианты перебираются по очереди: i-й вариант берется у каждого слова, где он есть
+        queries = []
+        for i in range(variants):
+            variant = ' '.join(options[min(i, len(options) - 1)] for options in corrected)
+            if variant not in queries:
+                queries.append(variant)
+        return queries
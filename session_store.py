@@ -0,0 +1,159 @@
+import sqlite3
+import time
+from array import array
+from collections import OrderedDict
+from flibusta_logger import logger
+from sqlite_store import SqliteStore, store_path
+from ttl_cache import TTLCache
+
+
+class SearchSession:
+    """Результат одного поиска: номера строк каталога и id книг для проверки, что строки не устарели
+    """
+
+    __slots__ = ('session_id', 'rows', 'book_ids', 'created')
+
+    def __init__(self, session_id, rows, book_ids, created=None) -> None:
+        self.session_id = session_id
+        self.rows = array('I', rows)
+        self.book_ids = array('I', book_ids)
+        self.created = created or time.time()
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class SessionStore(SqliteStore):
+    """Результаты поиска пользователей для перелистывания.
+    В памяти - LRU с ограничением по времени, у каждого пользователя не больше per_user последних поисков.
+    Если задан path, сессии дублируются в sqlite и переживают перезапуск бота; просроченные и лишние
+    сессии оттуда удаляются, так что база не растет бесконечно.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id INTEGER, session_id INTEGER, created REAL NOT NULL,
+            rows BLOB NOT NULL, book_ids BLOB NOT NULL, PRIMARY KEY (user_id, session_id));'''
+
+    def __init__(self, path=None, maxsize=10000, ttl=24 * 3600, per_user=3, prune_every=1000) -> None:
+        """
+        Args:
+            path (str, optional): файл sqlite для сессий, None - только в памяти
+            maxsize (int): сколько пользователей держать в памяти
+            ttl (float): сколько секунд живет сессия
+            per_user (int): сколько последних поисков пользователя хранить
+            prune_every (int): через сколько новых сессий чистить просроченные в базе
+        """
+        super().__init__(path)
+        self.ttl = ttl
+        self.per_user = per_user
+        self.prune_every = prune_every
+        self.users = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.created = 0
+
+
+    def opened(self, db):
+        self.prune()
+
+    def prune(self):
+        with self.db:
+            self.db.execute('DELETE FROM sessions WHERE created < ?', (time.time() - self.ttl,))
+
+    def user_sessions(self, user_id):
+        """Сессии пользователя в памяти, от старой к новой
+        """
+        sessions = self.users.get(user_id)
+        if sessions is None:
+            sessions = OrderedDict()
+            self.users.set(user_id, sessions)
+        return sessions
+
+    def next_id(self, user_id, sessions):
+        last = next(reversed(sessions), 0)
+        if self.shared:
+            row = self.connect().execute('SELECT MAX(session_id) FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+            last = max(last, row[0] or 0)
+        return last + 1
+
+    def create(self, user_id, rows, book_ids):
+        """Сохраняем результат нового поиска, самый старый поиск пользователя сверх per_user забывается
+
+        Args:
+            user_id (int): пользователь
+            rows (list): номера строк каталога от самой подходящей книги
+            book_ids (list): id книг этих строк
+
+        Returns:
+            SearchSession: новая сессия
+        """
+        sessions = self.user_sessions(user_id)
+        session = SearchSession(self.next_id(user_id, sessions), rows, book_ids)
+        sessions[session.session_id] = session
+        while len(sessions) > self.per_user:
+            sessions.popitem(last=False)
+        # новый поиск продлевает жизнь всех сессий пользователя в памяти
+        self.users.set(user_id, sessions)
+        if self.shared:
+            try:
+                self.save(user_id, session)
+            except sqlite3.Error as error:
+                logger.warning(f'Не удалось сохранить результат поиска.\nОшибка: {error}')
+        return session
+
+    def save(self, user_id, session):
+        db = self.connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)',
+                       (user_id, session.session_id, session.created,
+                        session.rows.tobytes(), session.book_ids.tobytes()))
+            db.execute('DELETE FROM sessions WHERE user_id = ? AND session_id <= ?',
+                       (user_id, session.session_id - self.per_user))
+        self.created += 1
+        if self.created % self.prune_every == 0:
+            self.prune()
+
+    def get(self, user_id, session_id=None):
+        """Сессия пользователя, по умолчанию последняя
+
+        Returns:
+            SearchSession: сессия или None, если она просрочена или вытеснена
+        """
+        sessions = self.users.get(user_id)
+        if sessions:
+            if session_id is None:
+                return sessions[next(reversed(sessions))]
+            if session_id in sessions:
+                return sessions[session_id]
+        if not self.shared:
+            return None
+        try:
+            return self.load(user_id, session_id)
+        except sqlite3.Error as error:
+            logger.warning(f'Не удалось прочитать результат поиска.\nОшибка: {error}')
+            return None
+
+    def load(self, user_id, session_id):
+        """Достаем сессию из базы, например после перезапуска бота, и возвращаем ее в память
+        """
+        query = 'SELECT session_id, created, rows, book_ids FROM sessions WHERE user_id = ? AND created >= ?'
+        params = [user_id, time.time() - self.ttl]
+        if session_id is not None:
+            query += ' AND session_id = ?'
+            params.append(session_id)
+        row = self.connect().execute(query + ' ORDER BY session_id DESC LIMIT 1', params).fetchone()
+        if row is None:
+            return None
+        rows, book_ids = array('I'), array('I')
+        rows.frombytes(row[2])
+        book_ids.frombytes(row[3])
+        session = SearchSession(row[0], rows, book_ids, created=row[1])
+        sessions = self.user_sessions(user_id)
+        sessions[session.session_id] = session
+        for key in sorted(sessions):
+            sessions.move_to_end(key)
+        while len(sessions) > self.per_user:
+            sessions.popitem(last=False)
+        return session
+
+
+session_store = SessionStore(path=store_path('FLIBUSTA_SESSION_DB', './files/sessions.sqlite'))
@@ -0,0 +1,53 @@
+import os
+import sqlite3
+
+
+class SqliteStore:
+    """Основа хранилищ бота на sqlite. Хранилище с path пишет в файл sqlite в режиме WAL, его видят
+    все процессы бота и оно переживает перезапуск. Хранилище без path (None) держит ту же базу в памяти
+    своего процесса. Наследник задает схему в schema и, если нужно, дополняет открытие в opened.
+    """
+
+    # SQL, выполняемый при каждом открытии базы: CREATE TABLE IF NOT EXISTS и индексы
+    schema = ''
+    # базу используют из нескольких потоков под своей блокировкой (см. BookCache)
+    threaded = False
+
+    def __init__(self, path=None) -> None:
+        """
+        Args:
+            path (str, optional): файл базы, None - база в памяти процесса
+        """
+        self.path = path
+        self.db = None
+
+    @property
+    def shared(self):
+        """Видят ли данные другие процессы бота
+        """
+        return self.path is not None
+
+    def connect(self):
+        """База открывается при первом обращении: папки ./files может еще не быть при импорте
+        """
+        if self.db is None:
+            if self.path is None:
+                db = sqlite3.connect(':memory:', check_same_thread=not self.threaded)
+            else:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                db = sqlite3.connect(self.path, check_same_thread=not self.threaded)
+                db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(self.schema)
+            self.db = db
+            self.opened(db)
+        return self.db
+
+    def opened(self, db):
+        """Вызывается один раз после открытия базы и создания схемы
+        """
+
+
+def store_path(name, default):
+    """Путь базы хранилища из переменной окружения: не задана - default, пустая строка - память процесса
+    """
+    return os.getenv(name, default) or None
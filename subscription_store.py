@@ -0,0 +1,97 @@
+import json
+import os
+from flibusta_logger import logger
+from sqlite_store import SqliteStore, store_path
+
+
+class SubscriptionStore(SqliteStore):
+    """Подписки пользователей на новые книги: пользователь -> время уведомления.
+    Хранится в sqlite с индексом по времени, так что подписка, отписка и выборка пользователей
+    одного времени не читают и не переписывают всю базу. Старый schedule.json переносится при первом открытии.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS subscriptions (user_id INTEGER PRIMARY KEY, notify_time TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS subscriptions_time ON subscriptions (notify_time, user_id);'''
+
+    def __init__(self, path='./files/subscriptions.sqlite', legacy_path='./files/schedule.json', batch_size=1000) -> None:
+        """
+        Args:
+            path (str, optional): файл базы, None - в памяти процесса
+            legacy_path (str): старый файл расписания для переноса
+            batch_size (int): сколько пользователей отдавать за раз
+        """
+        super().__init__(path)
+        self.legacy_path = legacy_path
+        self.batch_size = batch_size
+
+    def opened(self, db):
+        self.migrate()
+
+    def migrate(self):
+        """Переносим подписки из schedule.json и переименовываем его, чтобы не переносить повторно
+        """
+        if not os.path.exists(self.legacy_path):
+            return
+        try:
+            with open(self.legacy_path) as file:
+                schedule = json.load(file)
+            rows = [(int(item['user_id']), item['notify_time']) for item in schedule
+                    if item.get('notify_time') not in (None, 'None')]
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO subscriptions VALUES (?, ?)', rows)
+            os.replace(self.legacy_path, f'{self.legacy_path}.migrated')
+            logger.info(f'Подписки перенесены из {self.legacy_path}: {len(rows)}')
+        except Exception as error:
+            logger.warning(f'Не удалось перенести подписки из {self.legacy_path}.\nОшибка: {error}')
+
+    def set(self, user_id, notify_time):
+        """Подписываем пользователя на время или меняем время. notify_time None или 'None' - отписка
+        """
+        with self.connect() as db:
+            if notify_time in (None, 'None'):
+                db.execute('DELETE FROM subscriptions WHERE user_id = ?', (int(user_id),))
+            else:
+                db.execute('INSERT OR REPLACE INTO subscriptions VALUES (?, ?)', (int(user_id), notify_time))
+
+    def remove(self, user_id):
+        self.set(user_id, None)
+
+    def get(self, user_id):
+        """Время уведомления пользователя
+
+        Returns:
+            str: время или None, если пользователь не подписан
+        """
+        row = self.connect().execute(
+            'SELECT notify_time FROM subscriptions WHERE user_id = ?', (int(user_id),)).fetchone()
+        return row[0] if row else None
+
+    def count(self, notify_time):
+        return self.connect().execute(
+            'SELECT COUNT(*) FROM subscriptions WHERE notify_time = ?', (notify_time,)).fetchone()[0]
+
+    def users_for_slot(self, notify_time, after=0):
+        """Пользователи, подписанные на время, пачками по batch_size в порядке user_id.
+        Каждая пачка - отдельный запрос по индексу с продолжения после последнего id,
+        поэтому подписки, изменившиеся во время обхода, не ломают его
+
+        Args:
+            notify_time (str): время уведомления
+            after (int): начать с пользователей с id больше этого
+
+        Yields:
+            list: id пользователей
+        """
+        db = self.connect()
+        while True:
+            batch = [row[0] for row in db.execute(
+                'SELECT user_id FROM subscriptions WHERE notify_time = ? AND user_id > ? ORDER BY user_id LIMIT ?',
+                (notify_time, after, self.batch_size))]
+            if not batch:
+                return
+            yield batch
+            after = batch[-1]
+
+
+subscription_store = SubscriptionStore(path=store_path('FLIBUSTA_SUBSCRIPTION_DB', './files/subscriptions.sqlite'))
@@ -0,0 +1,90 @@
+import sqlite3
+import time
+from flibusta_logger import logger
+from sqlite_store import SqliteStore, store_path
+from ttl_cache import TTLCache
+
+
+# аннотации нет на странице книги
+NO_SUMMARY = 'отсутствует'
+
+
+class SummaryCache(SqliteStore):
+    """Кеш аннотаций книг по id книги: LRU в памяти перед необязательным хранилищем sqlite на диске.
+    Отсутствие аннотации тоже кешируется (негативный кеш), но на меньший срок.
+    Ошибки загрузки не кешируются.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS summaries (
+            book_id INTEGER PRIMARY KEY, summary TEXT NOT NULL, expires REAL NOT NULL);'''
+
+    def __init__(self, path=None, maxsize=4096, ttl=7 * 24 * 3600, negative_ttl=24 * 3600) -> None:
+        """
+        Args:
+            path (str, optional): файл sqlite, если не задан - кеш только в памяти
+            maxsize (int): записей в памяти
+            ttl (int): срок жизни аннотации в секундах
+            negative_ttl (int): срок жизни записи "аннотации нет" в секундах
+        """
+        super().__init__(path)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.disk_hits = 0
+
+
+    def get(self, book_id):
+        """Аннотация из кеша
+
+        Returns:
+            str: аннотация или None при промахе
+        """
+        summary = self.memory.get(book_id)
+        if summary is not None:
+            return summary
+        # без файла базы кеш живет только в памяти, вторая копия в sqlite ему не нужна
+        if not self.shared:
+            return None
+        try:
+            row = self.connect().execute('SELECT summary, expires FROM summaries WHERE book_id = ?', (book_id,)).fetchone()
+        except sqlite3.Error as error:
+            logger.warning(f'Не удалось прочитать кеш аннотаций.\nОшибка: {error}')
+            return None
+        if row is None or row[1] <= time.time():
+            return None
+        self.disk_hits += 1
+        self.memory.set(book_id, row[0], ttl=row[1] - time.time())
+        return row[0]
+
+    def set(self, book_id, summary):
+        """Сохраняем аннотацию. Пустая строка означает ошибку загрузки и не сохраняется
+        """
+        if not summary:
+            return
+        ttl = self.negative_ttl if summary == NO_SUMMARY else self.ttl
+        self.memory.set(book_id, summary, ttl=ttl)
+        if not self.shared:
+            return
+        try:
+            with self.connect() as db:
+                db.execute('INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)',
+                           (book_id, summary, time.time() + ttl))
+        except sqlite3.Error as error:
+            logger.warning(f'Не удалось записать кеш аннотаций.\nОшибка: {error}')
+
+    def stats(self):
+        """Счетчики кеша: попадания в память, попадания на диск и промахи мимо обоих
+
+        Returns:
+            dict: статистика
+        """
+        stats = self.memory.stats()
+        stats['disk_hits'] = self.disk_hits
+        stats['misses'] -= self.disk_hits
+        total = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['disk_hits']) / total if total else 0.0
+        return stats
+
+
+summary_cache = SummaryCache(path=store_path('FLIBUSTA_SUMMARY_DB', './files/summaries.sqlite'))
@@ -0,0 +1,65 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Кеш в памяти с вытеснением давно не использованных записей (LRU) и сроком жизни записей.
+    Считает попадания и промахи.
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600) -> None:
+        """
+        Args:
+            maxsize (int): максимум записей
+            ttl (float): срок жизни записи в секундах по умолчанию
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        item = self.data.get(key)
+        return item is not None and item[0] > time.monotonic()
+
+    def get(self, key, default=None):
+        """Значение по ключу, просроченная запись удаляется и считается промахом
+        """
+        item = self.data.get(key)
+        if item is None or item[0] <= time.monotonic():
+            if item is not None:
+                del self.data[key]
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value, ttl=None):
+        """Сохраняем значение. ttl переопределяет срок жизни для этой записи
+        """
+        self.data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        """Счетчики кеша
+
+        Returns:
+            dict: размер, попадания, промахи и доля попаданий
+        """
+        total = self.hits + self.misses
+        return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
@@ -0,0 +1,68 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+from flibusta_logger import logger
+
+
+# адрес, по которому Telegram шлет обновления, например https://example.com
+WEBHOOK_URL = os.getenv('FLIBUSTA_WEBHOOK_URL')
+# путь по умолчанию выводится из токена, чтобы обновления нельзя было подделать, угадав адрес
+WEBHOOK_PATH = os.getenv('FLIBUSTA_WEBHOOK_PATH') or \
+    '/webhook/' + hashlib.sha256(os.getenv('FLIBUSTA_BOT_TOKEN', '').encode()).hexdigest()[:16]
+# процессы слушают один порт (SO_REUSEPORT), ядро распределяет соединения от обратного прокси между ними
+WEBHOOK_HOST = os.getenv('FLIBUSTA_WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('FLIBUSTA_WEBHOOK_PORT', '8080'))
+# хранилища, которые процессы бота обязаны делить между собой
+SHARED_STORES = ('FLIBUSTA_SESSION_DB', 'FLIBUSTA_SUBSCRIPTION_DB', 'FLIBUSTA_BROADCAST_DB', 'FLIBUSTA_BOOK_CACHE_DB')
+WORKERS = int(os.getenv('FLIBUSTA_WEBHOOK_WORKERS', '0')) or os.cpu_count() or 1
+
+
+async def set_webhook():
+    import bot
+    try:
+        await bot.bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH)
+    finally:
+        await bot.bot.close()
+
+
+def run_worker():
+    """Один процесс бота: веб-приложение aiohttp, принимающее обновления от Telegram
+    """
+    from aiogram.utils import executor
+    import bot
+    executor.start_webhook(dispatcher=bot.dp, webhook_path=WEBHOOK_PATH,
+                           on_startup=bot.on_startup, on_shutdown=bot.on_shutdown,
+                           skip_updates=False, host=WEBHOOK_HOST, port=WEBHOOK_PORT, reuse_port=True)
+
+
+def main():
+    if not WEBHOOK_URL:
+        raise SystemExit('Не задан FLIBUSTA_WEBHOOK_URL')
+    in_memory = [name for name in SHARED_STORES if os.getenv(name) == '']
+    if WORKERS > 1 and in_memory:
+        # данные в памяти одного процесса не видны другим: ломались бы кнопки перелистывания, подписки,
+        # продолжение рассылок, а кеш книг одного процесса удалял бы файлы другого
+        raise SystemExit(f'Для нескольких процессов эти хранилища должны быть в sqlite: {", ".join(in_memory)}')
+    if 'FLIBUSTA_CONVERT_WORKERS' not in os.environ:
+        # пулы конвертации всех процессов вместе не должны занимать больше ядер, чем есть
+        os.environ['FLIBUSTA_CONVERT_WORKERS'] = str(max(1, (os.cpu_count() or 1) // WORKERS))
+    asyncio.run(set_webhook())
+    logger.info(f'Запускаем {WORKERS} процессов бота на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}')
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, name=f'bot-{number}') for number in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # aiohttp завершает процессы по SIGTERM так же аккуратно, как по Ctrl+C, с on_shutdown
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == '__main__':
+    main()